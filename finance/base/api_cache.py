@@ -0,0 +1,78 @@
+import hashlib
+
+from threading import Lock
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+
+_missing = object()
+
+
+class ApiCache(object):
+    """
+    Serialized API responses keyed by stock, path and query. Keys contain
+    Stock.version which the Importer bumps after writing prices or trades
+    of the stock, so only the responses of changed stocks are invalidated.
+    Hits and misses are counted per process.
+
+    @type :alias: str, CACHES alias
+    @type :timeout: int, seconds
+    """
+
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get_key(self, stock, request):
+        query = urlencode(sorted(
+            (name, value) for name, values in request.GET.lists() for value in values
+        ))
+        digest = hashlib.md5(
+            ('%s%s?%s' % (request.get_host(), request.path, query)).encode('utf-8')
+        ).hexdigest()
+        return 'api:%d:%d:%s' % (stock.id, stock.version, digest)
+
+    def get_or_set(self, key, get_data):
+        cache = caches[self.alias]
+        data = cache.get(key, _missing)
+        if data is not _missing:
+            self.count('hits')
+            return data
+        self.count('misses')
+        data = get_data()
+        cache.set(key, data, self.timeout)
+        return data
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            'backend': settings.CACHES[self.alias]['BACKEND'],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else None
+        }
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_api_cache():
+    """
+    @rtype: ApiCache | None, None if API_CACHE is not set
+    """
+    global _cache
+    if not settings.API_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ApiCache(settings.API_CACHE, settings.API_CACHE_TIMEOUT)
+    return _cache
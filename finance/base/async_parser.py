@@ -0,0 +1,237 @@
+import time
+import asyncio
+import logging
+
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from django.conf import settings
+from django.db import connection
+
+from .http_cache import get_response_cache
+from .parser import (
+    RETRY_STATUSES, ParserError, TaskTiming, get_retry_delay, get_conditional_headers,
+    has_new_trades, NasdaqPricesParser, NasdaqInsiderTradesParser,
+    stock_prices_parser, insider_trades_parser, get_failed_stocks
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class HostRateLimiter(object):
+    """
+    Spaces requests to the same host at least 1 / rate seconds apart.
+    May be shared by parsers running in different event loops.
+
+    @type :rate: float, requests per second per host
+    """
+
+    def __init__(self, rate):
+        assert rate > 0
+
+        self.interval = 1.0 / rate
+        self._next_slots = {}
+        self._lock = Lock()
+
+    async def wait(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slots.get(host, now))
+            self._next_slots[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class AsyncParser(object):
+    """
+    Same interface as ThreadedParser, but pages are fetched by an asyncio
+    event loop running in a background thread, so the number of requests
+    in flight is not bound to the number of OS threads. Rows are parsed with
+    the Nasdaq parsers' parse_* methods and passed to the callback in a
+    separate thread, so DB writes don't block the loop.
+
+    @type :parser: stock_prices_parser | insider_trades_parser
+    @type :stocks: list
+    @type :concurrency: int, max requests in flight
+    @type :callback: None | callable
+    @type :rate_limiter: None | HostRateLimiter
+    @type :timeout: float, seconds per request
+    @type :watermarks: None | dict, stock slug => date of the latest stored row
+    @type :timings: list of TaskTiming
+    """
+    result = None
+    timings = None
+
+    def __init__(self, parser, stocks, concurrency=100, callback=None,
+                 rate_limiter=None, timeout=30, watermarks=None):
+        assert (parser is stock_prices_parser) or (parser is insider_trades_parser)
+        assert isinstance(stocks, list)
+        assert isinstance(concurrency, int) and concurrency > 0
+        assert callable(callback) or callback is None
+        assert isinstance(rate_limiter, HostRateLimiter) or rate_limiter is None
+        assert isinstance(watermarks, dict) or watermarks is None
+
+        self.parser = parser
+        self.stocks = stocks
+        self.concurrency = concurrency
+        self.callback = callback
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.watermarks = watermarks or {}
+        self.result = []
+        self.timings = []
+        self.thread = Thread(target=self._run_loop)
+
+    def start_all(self):
+        self.thread.start()
+
+    def join_all(self):
+        self.thread.join()
+
+    def get_failed_stocks(self):
+        return get_failed_stocks(self.timings)
+
+    def _run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._run_all())
+        finally:
+            loop.close()
+
+    async def _run_all(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                self._session = session
+                task = (
+                    self._parse_stock_prices if self.parser is stock_prices_parser
+                    else self._parse_insider_trades
+                )
+                await asyncio.gather(*[
+                    self._timed(task, slug, self.watermarks.get(slug)) for slug in self.stocks
+                ])
+        finally:
+            self._executor.submit(connection.close)
+            self._executor.shutdown()
+
+    async def _timed(self, task, stock_slug, *args):
+        """
+        Runs a task and then its follow-up tasks, each one timed separately
+        without the time of the callback
+        """
+        stats = {'fetch_time': 0, 'bytes': 0, 'rows': 0, 'callback_time': 0}
+        started = time.time()
+        try:
+            tasks = await task(stats, stock_slug, *args)
+        except Exception as e:
+            elapsed = time.time() - started - stats.pop('callback_time')
+            self.timings.append(TaskTiming(stock_slug, task.__name__, elapsed, e, **stats))
+            logger.exception('Parser task error, %s%r', task.__name__, (stock_slug,) + args)
+            return
+        elapsed = time.time() - started - stats.pop('callback_time')
+        self.timings.append(TaskTiming(stock_slug, task.__name__, elapsed, None, **stats))
+        await asyncio.gather(*[
+            self._timed(next_task, stock_slug, *next_args) for next_task, next_args in tasks
+        ])
+
+    async def _parse_stock_prices(self, stats, stock_slug, watermark=None):
+        parser = NasdaqPricesParser(stock_slug)
+        await self._emit(parser.parse_stock_prices(await self._fetch(parser.url, stats)), stats)
+        return ()
+
+    async def _parse_insider_trades(self, stats, stock_slug, watermark=None):
+        parser = NasdaqInsiderTradesParser(stock_slug)
+        rows, urls = parser.parse_page(await self._fetch(parser.url, stats))
+        await self._emit(rows, stats)
+        if watermark is None:
+            return [(self._parse_insider_trades_page, (url,)) for url in urls]
+        return self._get_next_page_tasks(rows, urls, watermark)
+
+    async def _parse_insider_trades_page(self, stats, stock_slug, url, watermark=None,
+                                         next_urls=()):
+        parser = NasdaqInsiderTradesParser(stock_slug)
+        rows = parser.parse_insider_trades(await self._fetch(url, stats))
+        await self._emit(rows, stats)
+        return self._get_next_page_tasks(rows, next_urls, watermark)
+
+    def _get_next_page_tasks(self, rows, urls, watermark):
+        if not urls or not has_new_trades(rows, watermark):
+            return ()
+        return [(self._parse_insider_trades_page, (urls[0], watermark, urls[1:]))]
+
+    async def _fetch(self, url, stats):
+        """
+        @type :stats: dict, fetch_time and bytes of the task are added
+        """
+        started = time.time()
+        try:
+            html = await self._get_with_retries(url)
+        finally:
+            stats['fetch_time'] += time.time() - started
+        stats['bytes'] += len(html)
+        return html
+
+    async def _get_with_retries(self, url):
+        attempt = 0
+        while True:
+            try:
+                return await self._get(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+                if attempt >= settings.PARSER_RETRIES:
+                    logger.debug('Parser GET error, %s: %s' % (url, e))
+                    raise ParserError('Parser GET error, %s: %s' % (url, e))
+                delay = get_retry_delay(attempt)
+                logger.debug('Parser GET error, %s: %s, retry in %.2fs', url, e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _get(self, url):
+        cache = get_response_cache()
+        entry = cache.get(url) if cache else None
+        if entry is not None and cache.is_fresh(entry):
+            cache.count('hits')
+            return entry.body
+
+        async with self._semaphore:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.wait(url)
+            headers = get_conditional_headers(entry)
+            async with self._session.get(url, headers=headers) as response:
+                if response.status == 304 and entry is not None:
+                    cache.count('revalidated')
+                    cache.touch(url, entry)
+                    return entry.body
+                if response.status in RETRY_STATUSES:
+                    raise RetryableError('status %d' % response.status)
+                if response.status != 200:
+                    logger.debug('Parser GET error %d, %s' % (response.status, url))
+                    raise ParserError('Parser GET error %d, %s' % (response.status, url))
+                text = await response.text()
+                if cache:
+                    cache.count('misses')
+                    cache.set(
+                        url, text, response.headers.get('ETag'),
+                        response.headers.get('Last-Modified')
+                    )
+                return text
+
+    async def _emit(self, rows, stats):
+        stats['rows'] += len(rows)
+        if callable(self.callback):
+            started = time.time()
+            await asyncio.get_event_loop().run_in_executor(self._executor, self.callback, rows)
+            stats['callback_time'] += time.time() - started
+        else:
+            self.result.append(rows)
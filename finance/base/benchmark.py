@@ -0,0 +1,464 @@
+import os
+import re
+import time
+import random
+
+from io import StringIO
+from datetime import date, timedelta
+from decimal import Decimal
+from threading import Thread
+from contextlib import redirect_stdout
+from collections import OrderedDict
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+from lxml.html import fromstring
+
+from .importer import Importer
+from .parser import (
+    PRICES, INSIDER_TRADES, NasdaqPricesParser, NasdaqInsiderTradesParser, parse_page,
+    parse_pages, start_parse_pool
+)
+from .models import Stock, StockPrice, Insider, InsiderTrade, STOCK_PRICE_TYPES, delta_cache
+from .store import PriceSeries
+from .serializers import (
+    StockPriceSerializer, InsiderTradeSerializer, StockPriceRowSerializer,
+    InsiderTradeRowSerializer
+)
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_pages')
+
+SCENARIOS = OrderedDict()
+
+
+class Rollback(Exception):
+    pass
+
+
+def scenario(name):
+    """
+    Registers a benchmark scenario: (options) => list of results dicts with
+    name, rows and seconds keys, options are the benchmark command options
+    """
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+def measure(func, repeat=3):
+    """
+    @rtype: float, the best of repeat runs in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_in_rollback(func, *args, **kwargs):
+    """
+    Runs func in a transaction which is rolled back afterwards, so the
+    generated data is not left in the database
+    """
+    result = None
+    try:
+        with transaction.atomic():
+            result = func(*args, **kwargs)
+            raise Rollback
+    except Rollback:
+        pass
+    return result
+
+
+def create_stock(slug, rows, insiders=50):
+    """
+    A stock with rows random prices and rows random insider trades
+    """
+    stock = Stock.objects.create(slug=slug)
+    day = date.today() - timedelta(days=rows)
+    value = Decimal(random.randint(1000, 20000)) / 100
+    prices = []
+    for i in range(rows):
+        value = max(Decimal('0.01'), value + Decimal(random.randint(-500, 500)) / 100)
+        prices.append(StockPrice(
+            stock=stock, date=day + timedelta(days=i), open=value, high=value + 1,
+            low=value - 1, close=value, volume=random.randint(0, 10 ** 6)
+        ))
+    StockPrice.objects.bulk_create(prices)
+    Insider.objects.bulk_create([
+        Insider(name='Insider %d' % i, stock=stock) for i in range(insiders)
+    ])
+    insider_list = list(Insider.objects.filter(stock=stock))
+    InsiderTrade.objects.bulk_create([
+        InsiderTrade(
+            date=day + timedelta(days=i), insider=random.choice(insider_list), stock=stock,
+            relation='Director', transaction_type='Buy', owner_type='direct',
+            shares_traded=random.randint(1, 10 ** 5),
+            last_price=value, shares_held=random.randint(1, 10 ** 6)
+        )
+        for i in range(rows)
+    ])
+    # Statistics of a live database, otherwise the planner expects a row per stock
+    with connection.cursor() as cursor:
+        for model in (StockPrice, Insider, InsiderTrade):
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(model._meta.db_table))
+    return stock
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if re.match(r'^/symbol/[\w.-]+/historical$', path):
+            body = self.server.pages['historical']
+        elif re.match(r'^/symbol/[\w.-]+/insider-trades$', path):
+            body = self.server.pages['insider-trades']
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubNasdaqServer(object):
+    """
+    Serves the saved pages of PAGES_DIR for every ticker on a local port, so
+    imports are benchmarked offline. Insider trades pages 2-10 repeat the
+    first page, their rows are skipped by the upsert.
+
+    Use as a context manager, NASDAQ_URL points to the server inside it.
+    """
+    url = None
+
+    def __init__(self):
+        self.pages = {}
+        for name in ('historical', 'insider-trades'):
+            with open(os.path.join(PAGES_DIR, '%s.html' % name), 'rb') as f:
+                self.pages[name] = f.read()
+        self._server = None
+        self._settings = None
+
+    def __enter__(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.pages = self.pages
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self._server.server_port
+        self._settings = override_settings(
+            NASDAQ_URL=self.url, PARSER_CACHE_DIR=None, PARSER_RETRIES=0
+        )
+        self._settings.enable()
+        return self
+
+    def __exit__(self, *args):
+        self._settings.disable()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def generate_data(tickers, days=250, insiders=10, trades=100, prefix='benchmark'):
+    """
+    Synthetic stocks with days of prices and insider trades each, generated
+    by PostgreSQL in one statement per table for large ticker counts
+
+    @rtype: list of stock slugs
+    """
+    tables = dict(
+        (model.__name__, connection.ops.quote_name(model._meta.db_table))
+        for model in (Stock, StockPrice, Insider, InsiderTrade)
+    )
+    params = {
+        'tickers': tickers, 'days': days, 'insiders': insiders,
+        'trades': max(trades // insiders, 1), 'start': date.today() - timedelta(days=days),
+        'prefix': '%s-' % prefix
+    }
+    statements = (
+        'INSERT INTO {Stock} (slug, version) '
+        'SELECT %(prefix)s || i, 0 FROM generate_series(1, %(tickers)s) i',
+
+        'INSERT INTO {StockPrice} (stock_id, date, open, high, low, close, volume) '
+        'SELECT id, %(start)s + d, p, p + 1, p - 1, round(p + random()::numeric - 0.5, 4), '
+        '(random() * 1000000)::integer FROM ('
+        'SELECT s.id, d, round((50 + random() * 100)::numeric, 4) AS p '
+        'FROM {Stock} s, generate_series(0, %(days)s - 1) d '
+        'WHERE s.slug LIKE %(prefix)s || \'%%\''
+        ') prices',
+
+        'INSERT INTO {Insider} (name, stock_id) '
+        'SELECT \'Insider \' || i, s.id FROM {Stock} s, generate_series(1, %(insiders)s) i '
+        'WHERE s.slug LIKE %(prefix)s || \'%%\'',
+
+        'INSERT INTO {InsiderTrade} (date, insider_id, stock_id, relation, transaction_type, '
+        'owner_type, shares_traded, last_price, shares_held) '
+        'SELECT %(start)s + k, i.id, i.stock_id, \'Director\', \'Buy\', \'direct\', '
+        '(random() * 100000)::integer, round((50 + random() * 100)::numeric, 4), '
+        '(random() * 1000000)::integer '
+        'FROM {Insider} i JOIN {Stock} s ON s.id = i.stock_id, generate_series(0, %(trades)s - 1) k '
+        'WHERE s.slug LIKE %(prefix)s || \'%%\''
+    )
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql.format(**tables), params)
+        for table in tables.values():
+            cursor.execute('ANALYZE %s' % table)
+    return ['%s%d' % (params['prefix'], i) for i in range(1, tickers + 1)]
+
+
+@scenario('serializers')
+def serializers_scenario(options):
+    """
+    DRF ModelSerializer against RowSerializer, query and serialization
+    """
+    rows, repeat = options['rows'], options['repeat']
+
+    def run():
+        stock = create_stock('benchmark-serializers', rows)
+        prices = StockPrice.objects.filter(stock=stock)
+        trades = InsiderTrade.objects.filter(stock=stock)
+        cases = (
+            ('prices drf', lambda: StockPriceSerializer(
+                prices.select_related('stock'), many=True
+            ).data),
+            ('prices rows', lambda: StockPriceRowSerializer(
+                StockPriceRowSerializer.get_rows(prices), many=True
+            ).data),
+            ('trades drf', lambda: InsiderTradeSerializer(
+                trades.select_related('insider'), many=True
+            ).data),
+            ('trades rows', lambda: InsiderTradeRowSerializer(
+                InsiderTradeRowSerializer.get_rows(trades), many=True
+            ).data)
+        )
+        return [
+            {'name': name, 'rows': rows, 'seconds': measure(func, repeat)}
+            for name, func in cases
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('store')
+def store_scenario(options):
+    """
+    Analytics and delta from PostgreSQL against a loaded PriceSeries
+    """
+    rows, repeat = options['rows'], options['repeat']
+
+    def run():
+        stock = create_stock('benchmark-store', rows)
+        series = PriceSeries.load(stock)
+        date_to = date.today()
+        date_from = date_to - timedelta(days=rows // 2)
+        thresholds = [0, 1, 2, 5, 10, 20, 50, 100]
+        cases = (
+            ('series load', lambda: PriceSeries.load(stock)),
+            ('analytics sql', lambda: StockPrice.objects.analytics(stock, date_from, date_to)),
+            ('analytics store', lambda: series.analytics(stock, date_from, date_to)),
+            ('delta sql', lambda: [
+                StockPrice.objects.delta(stock, max_delta, type_)
+                for type_ in STOCK_PRICE_TYPES for max_delta in thresholds
+            ]),
+            ('delta store', lambda: [
+                series.deltas(thresholds, type_) for type_ in STOCK_PRICE_TYPES
+            ])
+        )
+        return [
+            {'name': name, 'rows': rows, 'seconds': measure(func, repeat)}
+            for name, func in cases
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('import')
+def import_scenario(options):
+    """
+    Importer backends against StubNasdaqServer: a full import into an empty
+    database, a repeated one where all rows are skipped and an incremental
+    one. The Importer commits from its threads, so this needs the throwaway
+    database of the benchmark command.
+    """
+    tickers = ['import-%d' % i for i in range(options['import_tickers'])]
+    results = []
+    with StubNasdaqServer():
+        for name, backend, incremental, clean in (
+            ('threads', 'threads', False, True),
+            ('asyncio', 'asyncio', False, True),
+            ('pipeline', 'pipeline', False, True),
+            ('threads repeated', 'threads', False, False),
+            ('threads incremental', 'threads', True, False)
+        ):
+            if clean:
+                Stock.objects.all().delete()
+            started = time.perf_counter()
+            rows = run_import(tickers, backend, options['threads'], incremental)
+            results.append({
+                'name': 'import %s' % name, 'rows': rows, 'seconds': time.perf_counter() - started
+            })
+    Stock.objects.all().delete()
+    return results
+
+
+@scenario('parser')
+def parser_scenario(options):
+    """
+    Parsing of the saved Nasdaq pages, 100 pages per case, against parsing
+    the whole page with lxml alone
+    """
+    pages = dict(
+        (name, body.decode('utf-8')) for name, body in StubNasdaqServer().pages.items()
+    )
+    prices_parser = NasdaqPricesParser('benchmark')
+    trades_parser = NasdaqInsiderTradesParser('benchmark')
+    cases = (
+        ('lxml prices page', lambda html: fromstring(html), pages['historical']),
+        ('prices page', prices_parser.parse_stock_prices, pages['historical']),
+        ('lxml insider trades page', lambda html: fromstring(html), pages['insider-trades']),
+        ('insider trades page', trades_parser.parse_page, pages['insider-trades'])
+    )
+    results = []
+    for name, parse, html in cases:
+        results.append({
+            'name': name,
+            'rows': 100,
+            'seconds': measure(lambda: [parse(html) for _ in range(100)], options['repeat'])
+        })
+    return results
+
+
+@scenario('parse_pool')
+def parse_pool_scenario(options):
+    """
+    Parsing of options['pages'] saved pages, half prices and half insider
+    trades, in this process and in parse pools from one process up to
+    options['parse_processes'], with parse_pages tasks of
+    options['parse_chunk_size'] pages. The last case submits a page per task
+    and gets dicts back, as the pipeline did before.
+    """
+    pages = StubNasdaqServer().pages
+    tasks = [
+        (kind, 'benchmark', pages[name].decode('utf-8'), True)
+        for kind, name in ((PRICES, 'historical'), (INSIDER_TRADES, 'insider-trades'))
+    ] * (options['pages'] // 2)
+    chunk_size = options['parse_chunk_size']
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    max_processes = options['parse_processes'] or os.cpu_count() or 1
+
+    results = [{
+        'name': 'no pool',
+        'rows': len(tasks),
+        'seconds': measure(lambda: parse_pages(tasks), options['repeat'])
+    }]
+    sizes = sorted(set([2 ** i for i in range(max_processes.bit_length())] + [max_processes]))
+    for processes in sizes:
+        with start_parse_pool(processes) as pool:
+            results.append({
+                'name': 'pool %d processes' % processes,
+                'rows': len(tasks),
+                'seconds': measure(lambda: list(pool.map(parse_pages, chunks)), options['repeat'])
+            })
+    with start_parse_pool(max_processes) as pool:
+        results.append({
+            'name': 'pool %d, page per task' % max_processes,
+            'rows': len(tasks),
+            'seconds': measure(
+                lambda: [f.result() for f in [pool.submit(parse_page, *task) for task in tasks]],
+                options['repeat']
+            )
+        })
+    return results
+
+
+def run_import(tickers, backend, thread_number, incremental=False):
+    """
+    The import_data command without its output
+
+    @rtype: int, parsed rows
+    """
+    with redirect_stdout(StringIO()):
+        importer = Importer(
+            tickers=tickers, backend=backend, thread_number=thread_number,
+            incremental=incremental
+        )
+        if backend == 'pipeline':
+            importer.run_pipeline()
+        else:
+            parsers = [importer.import_stock_prices(), importer.import_insider_trades()]
+            for parser in parsers:
+                parser.join_all()
+            importer.flush()
+    return sum(
+        total.inserted + total.updated + total.skipped
+        for total in (importer.prices_writer.total, importer.trades_writer.total)
+    )
+
+
+# case name, url name, by stock, query
+API_CASES = (
+    ('stock list', 'stock-list', False, {}),
+    ('stock prices', 'stock-detail', True, {}),
+    ('stock prices stream', 'stock-detail', True, {'stream': 'json'}),
+    ('insider trades', 'insiders-trades', True, {}),
+    ('delta', 'delta-list', True, {'type_': 'close', 'max_delta': 5}),
+    ('delta batch', 'delta-batch', True, {'type_': 'close', 'max_deltas': '1,2,5,10,20'}),
+    ('analytics', 'analytics', True, {'date_from': '2000-01-01', 'date_to': '2100-01-01'}),
+    ('market analytics', 'market-analytics', False, {
+        'date_from': '2000-01-01', 'date_to': '2100-01-01', 'limit': 100
+    }),
+    ('batch 100 tickers', 'stock-batch', False, {'trades': 1})
+)
+
+
+@scenario('api')
+def api_scenario(options):
+    """
+    Every /api/ endpoint on options['tickers'] generated stocks of
+    options['days'] prices, with the API cache, price store and delta memo off
+    """
+    def run():
+        slugs = generate_data(options['tickers'], options['days'])
+        stock = Stock.objects.get(slug=slugs[0])
+        client = Client()
+        results = []
+        for name, url_name, by_stock, query in API_CASES:
+            kwargs = {'api': True}
+            if by_stock:
+                kwargs['slug'] = stock.slug
+            stocks = slugs[:1] if by_stock else slugs
+            if url_name == 'stock-batch':
+                stocks = slugs[:100]
+                query = dict(query, tickers=','.join(stocks))
+            url = reverse(url_name, kwargs=kwargs)
+            results.append({
+                'name': name,
+                'rows': options['days'] * len(stocks),
+                'seconds': measure(lambda: _get(client, url, query), options['repeat'])
+            })
+        return results
+
+    with override_settings(ALLOWED_HOSTS=['testserver'], API_CACHE=None, PRICE_STORE_MAX_SIZE=None):
+        return run_in_rollback(run)
+
+
+def _get(client, url, query):
+    delta_cache.clear()
+    response = client.get(url, query)
+    if response.streaming:
+        b''.join(response.streaming_content)
+    assert response.status_code == 200, '%s returned %d' % (url, response.status_code)
@@ -0,0 +1,125 @@
+from collections import namedtuple
+
+from django.db import connection, connections
+
+
+# changed: frozenset of the returning column values of inserted and updated rows
+UpsertResult = namedtuple('UpsertResult', ('inserted', 'updated', 'skipped', 'changed'))
+
+
+def bulk_upsert(model, fields, rows, conflict_fields, update_fields=None, returning=None):
+    """
+    Multi-row INSERT ... ON CONFLICT (PostgreSQL >= 9.5)
+
+    Conflicting rows are updated only when one of update_fields actually
+    changed, otherwise they are counted as skipped. Without update_fields
+    conflicts are ignored (DO NOTHING). Rows are inserted in conflict_fields
+    order, so concurrent upserts lock the same keys in the same order
+    instead of deadlocking.
+
+    @type :model: django.db.models.Model subclass
+    @type :fields: tuple of column names
+    @type :rows: list of tuples ordered as fields
+    @type :conflict_fields: tuple of column names of an unique constraint
+    @type :update_fields: None | tuple of column names
+    @type :returning: None | column name collected to UpsertResult.changed
+    @rtype: UpsertResult
+    """
+    if not rows:
+        return UpsertResult(0, 0, 0, frozenset())
+
+    rows = sorted(rows, key=_get_sort_key(fields, conflict_fields))
+    values = 'VALUES %s' % ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(rows))
+    sql = _insert_sql(model, fields, values, conflict_fields, update_fields)
+    params = [value for row in rows for value in row]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql + ' RETURNING (xmax = 0), %s' % _returning_sql(returning), params)
+        returned = cursor.fetchall()
+
+    inserted = sum(1 for i, _ in returned if i)
+    updated = len(returned) - inserted
+    changed = frozenset(value for _, value in returned) if returning else frozenset()
+    return UpsertResult(inserted, updated, len(rows) - len(returned), changed)
+
+
+def merge_from(model, fields, source_table, conflict_fields, update_fields=None,
+               returning=None):
+    """
+    INSERT ... SELECT ... ON CONFLICT from a (staging) table with the same columns
+
+    Duplicates of the source table by conflict_fields are collapsed, so the
+    merge never affects a row twice.
+
+    @type :source_table: str, unquoted table name
+    @type :returning: None | column name collected to UpsertResult.changed
+    @rtype: UpsertResult
+    """
+    qn = connection.ops.quote_name
+    select = 'SELECT DISTINCT ON (%s) %s FROM %s' % (
+        ', '.join(qn(f) for f in conflict_fields),
+        ', '.join(qn(f) for f in fields),
+        qn(source_table)
+    )
+    sql = (
+        'WITH merged AS (%s RETURNING (xmax = 0) AS inserted, %s AS changed) '
+        'SELECT count(*) FILTER (WHERE inserted), count(*), array_agg(DISTINCT changed) '
+        'FROM merged'
+    ) % (
+        _insert_sql(model, fields, select, conflict_fields, update_fields),
+        _returning_sql(returning)
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM %s' % qn(source_table))
+        total, = cursor.fetchone()
+        cursor.execute(sql)
+        inserted, returned, values = cursor.fetchone()
+    changed = frozenset(values or ()) if returning else frozenset()
+    return UpsertResult(inserted, returned - inserted, total - returned, changed)
+
+
+def _returning_sql(returning):
+    return connection.ops.quote_name(returning) if returning else 'NULL'
+
+
+def _insert_sql(model, fields, source, conflict_fields, update_fields):
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    if update_fields:
+        action = 'DO UPDATE SET %s WHERE (%s) IS DISTINCT FROM (%s)' % (
+            ', '.join('%s = EXCLUDED.%s' % (qn(f), qn(f)) for f in update_fields),
+            ', '.join('%s.%s' % (table, qn(f)) for f in update_fields),
+            ', '.join('EXCLUDED.%s' % qn(f) for f in update_fields)
+        )
+    else:
+        action = 'DO NOTHING'
+    return 'INSERT INTO %s (%s) %s ON CONFLICT (%s) %s' % (
+        table,
+        ', '.join(qn(f) for f in fields),
+        source,
+        ', '.join(qn(f) for f in conflict_fields),
+        action
+    )
+
+
+def _get_sort_key(fields, key_fields):
+    """
+    Sort key of rows by key_fields values, None (which never conflicts) first
+    """
+    indexes = [fields.index(f) for f in key_fields]
+    return lambda row: tuple((row[i] is not None, row[i]) for i in indexes)
+
+
+def estimate_count(queryset):
+    """
+    Planner's row estimate of a queryset, cheap on large tables where
+    COUNT(*) has to scan all matching rows
+
+    @rtype: int
+    """
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+        plan = cursor.fetchone()[0]
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -1,5 +1,17 @@
 from django import forms
-from .models import STOCK_PRICE_TYPES
+from django.core.exceptions import ValidationError
+from .models import STOCK_PRICE_TYPES, PERIOD_CHANGE_COLUMNS
+
+
+class TickersField(forms.CharField):
+    """
+    Comma separated tickers => list of stock slugs, None if empty
+    """
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        tickers = [t.strip().lower() for t in value.split(',') if t.strip()]
+        return tickers or None
 
 
 class StockPriceDeltaForm(forms.Form):
@@ -12,3 +24,58 @@ class StockPriceDeltaForm(forms.Form):
 class StockPriceAnalyticsForm(forms.Form):
     date_from = forms.DateField(label='Дата, с')
     date_to = forms.DateField(label='Дата, по')
+
+
+class StockPriceDeltaBatchForm(forms.Form):
+    type_ = forms.ChoiceField(
+        label='Тип цены', choices=tuple((t, t) for t in STOCK_PRICE_TYPES)
+    )
+    max_deltas = forms.CharField(label='Максимальные изменения, через запятую')
+
+    MAX_THRESHOLDS = 50
+
+    def clean_max_deltas(self):
+        try:
+            max_deltas = sorted(set(
+                int(value) for value in self.cleaned_data['max_deltas'].split(',')
+            ))
+        except ValueError:
+            raise ValidationError('Enter comma separated integers')
+        if len(max_deltas) > self.MAX_THRESHOLDS:
+            raise ValidationError('At most %d thresholds' % self.MAX_THRESHOLDS)
+        return max_deltas
+
+
+class MarketAnalyticsForm(forms.Form):
+    date_from = forms.DateField(label='Дата, с')
+    date_to = forms.DateField(label='Дата, по')
+    tickers = TickersField(label='Тикеры, через запятую', required=False)
+    order = forms.ChoiceField(
+        label='Сортировка', initial='-close_percent', required=False,
+        choices=tuple(
+            (prefix + column, prefix + column)
+            for column in PERIOD_CHANGE_COLUMNS if not column.endswith(('_from', '_to'))
+            for prefix in ('-', '')
+        )
+    )
+    min_value = forms.DecimalField(label='Значение, от', required=False)
+    max_value = forms.DecimalField(label='Значение, до', required=False)
+    limit = forms.IntegerField(label='Количество', required=False, min_value=1)
+
+    def clean_order(self):
+        return self.cleaned_data['order'] or self.fields['order'].initial
+
+
+class StockBatchForm(forms.Form):
+    tickers = TickersField(label='Тикеры, через запятую')
+    date_from = forms.DateField(label='Дата, с', required=False)
+    date_to = forms.DateField(label='Дата, по', required=False)
+    trades = forms.BooleanField(label='Сделки инсайдеров', required=False)
+
+    MAX_TICKERS = 1000
+
+    def clean_tickers(self):
+        tickers = self.cleaned_data['tickers']
+        if len(tickers) > self.MAX_TICKERS:
+            raise ValidationError('At most %d tickers' % self.MAX_TICKERS)
+        return tickers
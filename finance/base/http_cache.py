@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+from threading import Lock
+from collections import namedtuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+CacheEntry = namedtuple('CacheEntry', ('body', 'etag', 'last_modified', 'stored_at'))
+
+
+class ResponseCache(object):
+    """
+    Persistent HTTP response cache, one file per URL. Entries younger than
+    ttl are used without a request, older ones are revalidated with
+    If-None-Match / If-Modified-Since. The least recently used files are
+    evicted when the cache grows over max_size.
+
+    @type :path: str, cache directory
+    @type :ttl: int, seconds
+    @type :max_size: int, bytes
+    """
+
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._scan())
+
+    def get(self, url):
+        """
+        @rtype: CacheEntry | None
+        """
+        path = self._get_path(url)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = CacheEntry(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.stored_at < self.ttl
+
+    def set(self, url, body, etag=None, last_modified=None):
+        path = self._get_path(url)
+        data = json.dumps(CacheEntry(body, etag, last_modified, time.time())._asdict())
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        tmp_path = None
+        try:
+            # Unique per writer, threads of a process may store the same url
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            new_size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception('Response cache write error, %s', url)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._size += new_size - old_size
+            evict = self._size > self.max_size
+        if evict:
+            self._evict()
+
+    def touch(self, url, entry):
+        """
+        Restart ttl of an entry revalidated by a 304 response
+        """
+        self.set(url, entry.body, entry.etag, entry.last_modified)
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _evict(self):
+        files = sorted(self._scan(), key=lambda item: item[2])
+        with self._lock:
+            target = self.max_size * 0.9
+            for path, size, _ in files:
+                if self._size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
+
+    def _scan(self):
+        """
+        @rtype: list of (path, size, access time)
+        """
+        result = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                result.append((entry.path, stat.st_size, stat.st_mtime))
+        return result
+
+    def _get_path(self, url):
+        return os.path.join(self.path, '%s.json' % hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_response_cache():
+    """
+    @rtype: ResponseCache | None, None if PARSER_CACHE_DIR is not set
+    """
+    global _cache
+    if not settings.PARSER_CACHE_DIR:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                settings.PARSER_CACHE_DIR, settings.PARSER_CACHE_TTL,
+                settings.PARSER_CACHE_MAX_SIZE
+            )
+    return _cache
@@ -1,38 +1,194 @@
-from django.db import IntegrityError
-from collections import Iterable
+import time
+import logging
 
+from datetime import date
+from threading import Lock
+from collections import Iterable, OrderedDict
+
+from django.db import connection
+
+from .db import UpsertResult
+from .utils import get_last_trading_day, get_percentiles
+from .loader import CopyPriceLoader
+from .pipeline import Pipeline
+from .async_parser import AsyncParser, HostRateLimiter
 from .parser import (
-    ThreadedParser, stock_prices_parser, insider_trades_parser, parse_tickers_file
+    PRICES, INSIDER_TRADES, ThreadedParser, stock_prices_parser, insider_trades_parser,
+    parse_tickers_file, start_parse_pool
 )
 from .models import Stock, StockPrice, Insider, InsiderTrade
 
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter(object):
+    """
+    Accumulates parsed rows and writes them with one statement per batch.
+    A failed batch is written again stock by stock, so a bad row loses only
+    the rows of its stock.
+
+    @type :name: str
+    @type :write: (rows: list of dicts with stock_id) => UpsertResult
+    @type :batch_size: int
+    @type :total: UpsertResult
+    @type :write_times: list of float, seconds per written batch
+    @type :failed: dict, stock id => error of writing its rows
+    """
+    total = None
+    write_times = None
+    failed = None
+
+    def __init__(self, name, write, batch_size=500):
+        assert callable(write)
+        assert isinstance(batch_size, int) and batch_size > 0
+
+        self.name = name
+        self.write = write
+        self.batch_size = batch_size
+        self.total = UpsertResult(0, 0, 0, frozenset())
+        self.write_times = []
+        self.failed = {}
+        self._rows = []
+        self._lock = Lock()
+
+    def add(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+            if len(self._rows) < self.batch_size:
+                return
+            rows, self._rows = self._rows, []
+        self._write(rows)
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        self._write(rows)
+
+    def _write(self, rows):
+        if not rows:
+            return
+        started = time.time()
+        try:
+            result = self.write(rows)
+        except Exception:
+            logger.exception('%s write error, %d rows, writing by stock', self.name, len(rows))
+            result = self._write_by_stock(rows)
+        elapsed = time.time() - started
+        with self._lock:
+            self.write_times.append(elapsed)
+            self.total = _add_results(self.total, result)
+        logger.info(
+            '%s flush: %d rows, %d inserted, %d updated, %d skipped',
+            self.name, len(rows), result.inserted, result.updated, result.skipped
+        )
+
+    def _write_by_stock(self, rows):
+        by_stock = OrderedDict()
+        for row in rows:
+            by_stock.setdefault(row['stock_id'], []).append(row)
+        result = UpsertResult(0, 0, 0, frozenset())
+        for stock_id, stock_rows in by_stock.items():
+            try:
+                result = _add_results(result, self.write(stock_rows))
+            except Exception as e:
+                logger.exception('%s write error, stock %d', self.name, stock_id)
+                with self._lock:
+                    self.failed[stock_id] = e
+        return result
+
+    def get_stats(self):
+        return OrderedDict((
+            ('batches', len(self.write_times)),
+            ('inserted', self.total.inserted),
+            ('updated', self.total.updated),
+            ('skipped', self.total.skipped),
+            ('time', get_percentiles(self.write_times))
+        ))
+
+
+def _add_results(total, result):
+    return UpsertResult(
+        total.inserted + result.inserted,
+        total.updated + result.updated,
+        total.skipped + result.skipped,
+        total.changed | result.changed
+    )
+
+
+def get_task_stats(timings):
+    """
+    Totals and percentiles of parser task measurements
+
+    @type :timings: list of TaskTiming
+    @rtype: OrderedDict
+    """
+    return OrderedDict((
+        ('tasks', len(timings)),
+        ('errors', sum(1 for t in timings if t.error is not None)),
+        ('bytes', sum(t.bytes for t in timings)),
+        ('rows', sum(t.rows for t in timings)),
+        ('time', get_percentiles([t.time for t in timings])),
+        ('fetch_time', get_percentiles([t.fetch_time for t in timings])),
+        ('parse_time', get_percentiles([t.parse_time for t in timings]))
+    ))
+
 
 class Importer(object):
     """
     @type :thread_number: int
     @type :tickers: Iterable | None
-    @type :import_stock_prices: () => ThreadedParser instance
-    @type :import_insider_trades: () => ThreadedParser instance
+    @type :batch_size: int
+    @type :backend: 'threads' | 'asyncio' | 'pipeline'
+    @type :concurrency: int, requests in flight for the asyncio backend
+    @type :rate_limit: None | float, requests per second per host (asyncio)
+    @type :timeout: float, request timeout in seconds (asyncio)
+    @type :parse_processes: None | int, parse pool size, the threads backend
+        parses in its threads without it, the pipeline uses all cores
+    @type :parse_chunk_size: int, pages per parse pool task (pipeline)
+    @type :incremental: bool, skip up to date stocks and stored rows
+    @type :import_stock_prices: () => ThreadedParser | AsyncParser instance
+    @type :import_insider_trades: () => ThreadedParser | AsyncParser instance
+    @type :load_stock_prices: () => CopyPriceLoader instance
+    @type :run_pipeline: () => Pipeline instance
     """
     stocks = None
+    prices_writer = None
+    trades_writer = None
+    price_watermarks = None
+    trade_watermarks = None
+    parse_pool = None
 
-    def __init__(self, thread_number=1, tickers=None):
+    BACKENDS = ('threads', 'asyncio', 'pipeline')
+
+    def __init__(self, thread_number=1, tickers=None, batch_size=500, backend='threads',
+                 concurrency=100, rate_limit=None, timeout=30, parse_processes=None,
+                 parse_chunk_size=10, incremental=False):
         assert isinstance(thread_number, int) and thread_number > 0
         assert isinstance(tickers, Iterable) or tickers is None
+        assert backend in self.BACKENDS
 
         self.thread_number = thread_number
+        self.backend = backend
+        self.concurrency = concurrency
+        self.rate_limiter = HostRateLimiter(rate_limit) if rate_limit else None
+        self.timeout = timeout
+        self.parse_processes = parse_processes
+        self.parse_chunk_size = parse_chunk_size
+        self.incremental = incremental
+        self.prices_writer = BatchWriter('Prices', self._write_prices, batch_size)
+        self.trades_writer = BatchWriter('Insider trades', self._write_trades, batch_size)
         self._prepare_stocks(tickers)
+        self._prepare_watermarks()
+        if backend == 'threads' and parse_processes:
+            # Forked parse processes must not share the DB connection opened above
+            connection.close()
+            self.parse_pool = start_parse_pool(parse_processes)
 
     def import_stock_prices(self):
         def callback(prices):
             self._create_prices(prices)
 
-        parser = ThreadedParser(
-            parser=stock_prices_parser,
-            stocks=list(self.stocks.keys()),
-            thread_number=self.thread_number,
-            callback=callback
-        )
+        parser = self._get_parser(stock_prices_parser, self.get_price_stocks(), callback)
         parser.start_all()
         return parser
 
@@ -40,34 +196,128 @@ class Importer(object):
         def callback(trades):
             self._create_trades(trades)
 
-        parser = ThreadedParser(
-            parser=insider_trades_parser,
-            stocks=list(self.stocks.keys()),
-            thread_number=self.thread_number,
-            callback=callback
+        parser = self._get_parser(
+            insider_trades_parser, list(self.stocks.keys()), callback, self.trade_watermarks
         )
         parser.start_all()
         return parser
 
+    def load_stock_prices(self):
+        loader = CopyPriceLoader(
+            stocks=dict((slug, self.stocks[slug]) for slug in self.get_price_stocks()),
+            thread_number=self.thread_number,
+            watermarks=self.price_watermarks,
+            parse_pool=self.parse_pool
+        )
+        loader.load()
+        Stock.objects.bump_versions(loader.result.changed)
+        return loader
+
+    def run_pipeline(self):
+        assert self.backend == 'pipeline'
+
+        pipeline = Pipeline(
+            stocks=list(self.stocks.keys()),
+            writers={PRICES: self._create_prices, INSIDER_TRADES: self._create_trades},
+            flush=self.flush,
+            fetch_workers=self.thread_number,
+            parse_workers=self.parse_processes,
+            parse_chunk_size=self.parse_chunk_size,
+            watermarks=self.trade_watermarks,
+            price_stocks=self.get_price_stocks()
+        )
+        return pipeline.run()
+
+    def flush(self):
+        """
+        Writes the remaining rows once the parsers are joined
+        """
+        self.prices_writer.flush()
+        self.trades_writer.flush()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def get_failed_stocks(self):
+        """
+        @rtype: dict, stock slug => error of writing its rows
+        """
+        slugs = dict((id_, slug) for slug, id_ in self.stocks.items())
+        failed = {}
+        for writer in (self.prices_writer, self.trades_writer):
+            failed.update((slugs[stock_id], error) for stock_id, error in writer.failed.items())
+        return failed
+
+    def get_price_stocks(self):
+        """
+        Stocks to fetch prices for, incremental import skips stocks that
+        already have prices of the last trading day. Prices of today are an
+        intraday snapshot, stocks with them are fetched again.
+        """
+        if not self.incremental:
+            return list(self.stocks.keys())
+        today = date.today()
+        last_trading_day = get_last_trading_day(today)
+        return [
+            slug for slug in self.stocks
+            if not last_trading_day <= self.price_watermarks.get(slug, date.min) < today
+        ]
+
+    def _get_parser(self, parser, stocks, callback, watermarks=None):
+        assert self.backend != 'pipeline'
+
+        if self.backend == 'asyncio':
+            return AsyncParser(
+                parser=parser,
+                stocks=stocks,
+                concurrency=self.concurrency,
+                callback=callback,
+                rate_limiter=self.rate_limiter,
+                timeout=self.timeout,
+                watermarks=watermarks
+            )
+        return ThreadedParser(
+            parser=parser,
+            stocks=stocks,
+            thread_number=self.thread_number,
+            callback=callback,
+            watermarks=watermarks,
+            parse_pool=self.parse_pool
+        )
+
     def _create_prices(self, prices):
+        # Prices of the latest stored day are written again, they may have
+        # been stored during trading, the upsert skips unchanged ones
+        if self.price_watermarks:
+            prices = [
+                p for p in prices
+                if p['stock'] not in self.price_watermarks
+                or p['date'] >= self.price_watermarks[p['stock']]
+            ]
         for price in prices:
             price['stock_id'] = self.stocks[price.pop('stock')]
-            try:
-                StockPrice.objects.create(**price)
-            except IntegrityError:
-                pass
+        self.prices_writer.add(prices)
 
     def _create_trades(self, trades):
         for trade in trades:
-            insider = Insider.objects.safety_get_or_create(
-                name=trade.pop('insider'),
-                stock_id=self.stocks[trade.pop('stock')]
-            )
-            trade['insider'] = insider
-            try:
-                InsiderTrade.objects.create(**trade)
-            except IntegrityError:
-                pass
+            trade['stock_id'] = self.stocks[trade.pop('stock')]
+        self.trades_writer.add(trades)
+
+    @staticmethod
+    def _write_prices(prices):
+        result = StockPrice.objects.upsert(prices)
+        Stock.objects.bump_versions(result.changed)
+        return result
+
+    @staticmethod
+    def _write_trades(trades):
+        named = [t for t in trades if t['insider']]
+        insiders = Insider.objects.resolve((t['insider'], t['stock_id']) for t in named)
+        for trade in named:
+            trade['insider_id'] = insiders[(trade['insider'], trade['stock_id'])]
+        result = InsiderTrade.objects.upsert(named)
+        Stock.objects.bump_versions(result.changed)
+        return result._replace(skipped=result.skipped + len(trades) - len(named))
 
     def _prepare_stocks(self, tickers):
         if tickers is not None:
@@ -77,6 +327,18 @@ class Importer(object):
             ])
         self.stocks = dict(Stock.objects.values_list('slug', 'id'))
 
+    def _prepare_watermarks(self):
+        self.price_watermarks = {}
+        self.trade_watermarks = {}
+        if not self.incremental:
+            return
+        slugs = dict((id_, slug) for slug, id_ in self.stocks.items())
+        for watermarks, model in ((self.price_watermarks, StockPrice),
+                                  (self.trade_watermarks, InsiderTrade)):
+            for stock_id, latest in model.objects.latest_dates().items():
+                if stock_id in slugs:
+                    watermarks[slugs[stock_id]] = latest
+
     @staticmethod
     def get_tickers(path=None):
         return parse_tickers_file(path or 'tickers.txt')
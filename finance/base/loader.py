@@ -0,0 +1,176 @@
+import time
+import logging
+
+from queue import Queue, Full
+from threading import Thread, Event
+
+from django.db import connection, transaction
+
+from .parser import ThreadedParser, stock_prices_parser
+from .models import StockPrice, STOCK_PRICE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+class RowStream(object):
+    """
+    Read-only file-like object over an iterator of rows in COPY text format
+
+    @type :rows: Iterator of tuples
+    """
+    rows_count = 0
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                line = _format_copy_row(next(self._rows))
+            except StopIteration:
+                break
+            self.rows_count += 1
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class CopyPriceLoader(object):
+    """
+    Backfill loader: streams parsed prices into a staging table with
+    COPY FROM STDIN and merges it into StockPrice with one statement.
+    Only a bounded number of parsed tickers is kept in memory.
+
+    @type :stocks: dict, slug => stock id
+    @type :thread_number: int
+    @type :queue_size: int, parsed tickers waiting for COPY
+    @type :watermarks: None | dict, stock slug => date, prices of earlier days are
+        not loaded
+    @type :parse_pool: None | ProcessPoolExecutor, see ThreadedParser
+    """
+    staging_table = 'stockprice_staging'
+
+    def __init__(self, stocks, thread_number=1, queue_size=None, watermarks=None,
+                 parse_pool=None):
+        assert isinstance(stocks, dict)
+        assert isinstance(thread_number, int) and thread_number > 0
+        assert isinstance(watermarks, dict) or watermarks is None
+
+        self.stocks = stocks
+        self.watermarks = watermarks or {}
+        self.thread_number = thread_number
+        self.parse_pool = parse_pool
+        self.queue_size = queue_size or thread_number * 2
+        self.rows_count = 0
+        self.copy_time = 0
+        self.merge_time = 0
+        self.result = None
+        self.parser = None
+
+    @property
+    def rows_per_second(self):
+        total_time = self.copy_time + self.merge_time
+        return self.rows_count / total_time if total_time else 0
+
+    def load(self):
+        """
+        @rtype: UpsertResult
+        """
+        rows = self._iter_rows()
+        stream = RowStream(rows)
+        try:
+            self._load(stream)
+        finally:
+            # Stops the parser threads if COPY or the merge failed
+            rows.close()
+
+        logger.info(
+            'COPY loader: %d rows, copy %.2fs, merge %.2fs, %.0f rows/s',
+            self.rows_count, self.copy_time, self.merge_time, self.rows_per_second
+        )
+        return self.result
+
+    def _load(self, stream):
+        qn = connection.ops.quote_name
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE %s ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA' % (
+                    qn(self.staging_table),
+                    ', '.join(qn(f) for f in STOCK_PRICE_COLUMNS),
+                    qn(StockPrice._meta.db_table)
+                )
+            )
+            started = time.time()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+                qn(self.staging_table),
+                ', '.join(qn(f) for f in STOCK_PRICE_COLUMNS)
+            ), stream)
+            self.copy_time = time.time() - started
+            self.rows_count = stream.rows_count
+
+            started = time.time()
+            self.result = StockPrice.objects.merge_from(self.staging_table)
+            self.merge_time = time.time() - started
+
+    def _iter_rows(self):
+        """
+        Parsed rows, when the generator is closed before the end the parser
+        is cancelled and its threads stop instead of blocking on the queue
+        """
+        queue = Queue(maxsize=self.queue_size)
+        stopped = Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        self.parser = ThreadedParser(
+            parser=stock_prices_parser,
+            stocks=list(self.stocks.keys()),
+            thread_number=self.thread_number,
+            callback=put,
+            parse_pool=self.parse_pool
+        )
+        self.parser.start_all()
+
+        def finish():
+            self.parser.join_all()
+            put(None)
+        Thread(target=finish).start()
+
+        fields = STOCK_PRICE_COLUMNS
+        try:
+            while True:
+                prices = queue.get()
+                if prices is None:
+                    break
+                for price in prices:
+                    watermark = self.watermarks.get(price['stock'])
+                    if watermark is not None and price['date'] < watermark:
+                        continue
+                    price['stock_id'] = self.stocks[price.pop('stock')]
+                    yield tuple(price[f] for f in fields)
+        finally:
+            self.parser.cancel()
+            stopped.set()
+
+
+def _format_copy_row(row):
+    return '\t'.join(_format_copy_value(value) for value in row) + '\n'
+
+
+def _format_copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
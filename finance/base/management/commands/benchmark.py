@@ -0,0 +1,109 @@
+import json
+import random
+import subprocess
+
+from datetime import datetime
+from collections import OrderedDict
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from finance.base.benchmark import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs benchmark scenarios on generated data and saved Nasdaq pages in a '
+        'throwaway database, optionally saving the results as JSON to compare '
+        'them between commits'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenarios', nargs='*', metavar='scenario',
+            help='scenarios to run, all by default: %s' % ', '.join(SCENARIOS)
+        )
+        parser.add_argument('--rows', type=int, default=10000, help='generated rows per stock')
+        parser.add_argument(
+            '--tickers', type=int, default=500,
+            help='generated stocks for the api scenario, e.g. 500, 5000 or 50000'
+        )
+        parser.add_argument('--days', type=int, default=250, help='prices per generated stock')
+        parser.add_argument(
+            '--import_tickers', type=int, default=50, help='tickers of the import scenario'
+        )
+        parser.add_argument('--threads', type=int, default=10, help='import threads')
+        parser.add_argument('--pages', type=int, default=400, help='pages of the parse_pool scenario')
+        parser.add_argument(
+            '--parse_processes', type=int, help='largest parse pool, cpu count by default'
+        )
+        parser.add_argument('--parse_chunk_size', type=int, default=10, help='pages per parse task')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best is taken')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--json', help='save the results to this file')
+        parser.add_argument('--compare', help='results file of a previous run to compare with')
+        parser.add_argument(
+            '--keepdb', action='store_true', help='keep the throwaway database between runs'
+        )
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        baseline = self._load_results(options['compare']) if options['compare'] else {}
+        random.seed(options['seed'])
+
+        results = OrderedDict()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb']
+        )
+        try:
+            for name in names:
+                self.stdout.write(self.style.SUCCESS('Scenario %s' % name))
+                results[name] = SCENARIOS[name](options)
+                for result in results[name]:
+                    self._write_result(result, baseline.get((name, result['name'])))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({
+                    'commit': self._get_commit(),
+                    'created': datetime.now().isoformat(),
+                    'options': dict((key, options[key]) for key in (
+                        'rows', 'tickers', 'days', 'import_tickers', 'threads', 'pages',
+                        'parse_processes', 'parse_chunk_size', 'repeat', 'seed'
+                    )),
+                    'results': results
+                }, f, indent=2)
+            self.stdout.write('Results saved to %s' % options['json'])
+
+    def _write_result(self, result, previous):
+        line = '  %-28s %10d rows %10.4fs' % (result['name'], result['rows'], result['seconds'])
+        if previous:
+            ratio = result['seconds'] / previous['seconds'] if previous['seconds'] else 0
+            line += '  x%.2f of %.4fs' % (ratio, previous['seconds'])
+        self.stdout.write(line)
+
+    @staticmethod
+    def _load_results(path):
+        """
+        @rtype: dict, (scenario, case name) => result
+        """
+        with open(path) as f:
+            data = json.load(f)
+        return dict(
+            ((scenario, result['name']), result)
+            for scenario, results in data['results'].items() for result in results
+        )
+
+    @staticmethod
+    def _get_commit():
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
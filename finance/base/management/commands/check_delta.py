@@ -0,0 +1,43 @@
+from django.core.management import BaseCommand, CommandError
+
+from finance.base.models import Stock, StockPrice, STOCK_PRICE_TYPES
+from finance.base.store import PriceSeries
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares SQL StockPrice.objects.delta, the one pass StockPrice.objects.deltas '
+        'and the numpy PriceSeries.deltas with the python_delta reference on the '
+        'stored prices, random series are checked by finance.base.tests.DeltaTestCase'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--thresholds', default='0,1,2,5,10,20')
+
+    def handle(self, *args, **options):
+        thresholds = [int(t) for t in options['thresholds'].split(',')]
+        errors = self._check(Stock.objects.all(), thresholds)
+        if errors:
+            raise CommandError('%d mismatches' % errors)
+        self.stdout.write(self.style.SUCCESS('delta, deltas and store match python_delta'))
+
+    def _check(self, stocks, thresholds):
+        errors = 0
+        for stock in stocks:
+            series = PriceSeries.load(stock)
+            for type_ in STOCK_PRICE_TYPES:
+                batch = StockPrice.objects.deltas(stock, thresholds, type_)
+                vectorized = series.deltas(thresholds, type_)
+                for max_delta in thresholds:
+                    expected = StockPrice.objects.python_delta(stock, max_delta, type_)
+                    for name, result in (
+                        ('delta', StockPrice.objects.delta(stock, max_delta, type_)),
+                        ('deltas', batch[max_delta]),
+                        ('store', vectorized[max_delta])
+                    ):
+                        if result != expected:
+                            errors += 1
+                            self.stdout.write(self.style.ERROR(
+                                'Mismatch: %s %s %s > %d' % (name, stock.slug, type_, max_delta)
+                            ))
+        return errors
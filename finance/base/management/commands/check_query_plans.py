@@ -0,0 +1,49 @@
+from django.core.management import BaseCommand, CommandError
+
+from finance.base.models import Stock
+from finance.base.query_plans import check_query_plans, QueryPlanError
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs EXPLAIN on the queries of every API endpoint and fails on sequential '
+        'scans and sorts, on the stored data. The same cases run on generated data '
+        'in finance.base.tests.QueryPlansTestCase.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', help='stock slug, the first stock with prices by default')
+        parser.add_argument('--verbose-plans', action='store_true', help='print every plan')
+
+    def handle(self, *args, **options):
+        stock = self._get_stock(options['stock'])
+
+        errors = 0
+        try:
+            for plan in check_query_plans(stock):
+                if options['verbose_plans'] or plan.found:
+                    self.stdout.write('%s %s\n  %s\n  %s' % (
+                        plan.name, plan.query, plan.sql,
+                        ', '.join('%s %s' % (n, r or '') for n, r in plan.nodes)
+                    ))
+                if plan.found:
+                    errors += 1
+                    self.stdout.write(self.style.ERROR(
+                        '  %s: %s' % (plan.name, ', '.join(plan.found))
+                    ))
+        except QueryPlanError as e:
+            raise CommandError(e)
+        if errors:
+            raise CommandError('%d queries without a suitable index' % errors)
+        self.stdout.write(self.style.SUCCESS('All endpoint queries use indexes'))
+
+    def _get_stock(self, slug):
+        stocks = Stock.objects.all()
+        if slug:
+            stocks = stocks.filter(slug=slug)
+        else:
+            stocks = stocks.filter(prices__isnull=False).order_by('id').distinct()
+        stock = stocks.first()
+        if stock is None:
+            raise CommandError('No stock to check, import data first')
+        return stock
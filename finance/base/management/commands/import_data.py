@@ -1,5 +1,12 @@
-from django.core.management import BaseCommand
-from finance.base.importer import Importer
+from collections import OrderedDict
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+
+from finance.base.models import ImportRun
+from finance.base.importer import Importer, get_task_stats
+from finance.base.parser import PRICES, INSIDER_TRADES, get_stock_timings
+from finance.base.http_cache import get_response_cache
 
 
 class Command(BaseCommand):
@@ -8,18 +15,196 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--path')
         parser.add_argument('--thread_number', type=int)
+        parser.add_argument('--batch_size', type=int)
+        parser.add_argument(
+            '--loader', choices=('batch', 'copy'), default='batch',
+            help='copy streams prices with COPY FROM STDIN, for full backfills'
+        )
+        parser.add_argument(
+            '--backend', choices=Importer.BACKENDS, default='threads',
+            help='asyncio keeps up to --concurrency requests in flight, '
+                 'pipeline overlaps fetching, parsing in processes and DB writes'
+        )
+        parser.add_argument('--concurrency', type=int)
+        parser.add_argument('--rate_limit', type=float, help='requests per second per host')
+        parser.add_argument('--timeout', type=float, help='request timeout, seconds')
+        parser.add_argument(
+            '--parse_processes', type=int,
+            help='parse pool size, threads backend parses in its threads without it'
+        )
+        parser.add_argument(
+            '--parse_chunk_size', type=int, help='pages per pipeline parse pool task'
+        )
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='fetch only stocks and insider trades pages newer than stored data'
+        )
 
     def handle(self, *args, **options):
+        started = timezone.now()
         kwargs = {
             'tickers': Importer.get_tickers(options['path'])
         }
         if options['thread_number']:
             kwargs['thread_number'] = options['thread_number']
+        if options['loader'] == 'copy' and options['backend'] == 'pipeline':
+            raise CommandError('COPY loader is not supported by the pipeline backend')
+        if options['parse_processes'] and options['backend'] == 'asyncio':
+            raise CommandError('Parse pool is not supported by the asyncio backend')
+        for name in ('batch_size', 'concurrency', 'rate_limit', 'timeout', 'parse_processes',
+                     'parse_chunk_size'):
+            if options[name]:
+                kwargs[name] = options[name]
+        kwargs['backend'] = options['backend']
+        kwargs['incremental'] = options['incremental']
         importer = Importer(**kwargs)
-        stock_prices_parser = importer.import_stock_prices()
-        insider_trades_parser = importer.import_insider_trades()
+        if options['incremental']:
+            self.stdout.write('Prices up to date: %d of %d tickers' % (
+                len(importer.stocks) - len(importer.get_price_stocks()), len(importer.stocks)
+            ))
+
+        prices_total = None
+        prices_writes = None
+        if options['backend'] == 'pipeline':
+            pipeline = importer.run_pipeline()
+            parsers = [pipeline]
+            timings = OrderedDict((
+                ('prices', [t for t in pipeline.timings if t.task == PRICES]),
+                ('insider_trades', [t for t in pipeline.timings if t.task == INSIDER_TRADES])
+            ))
+        else:
+            if options['loader'] == 'copy':
+                insider_trades_parser = importer.import_insider_trades()
+                loader = importer.load_stock_prices()
+                self.stdout.write('Prices: %d rows copied in %.2fs, %.0f rows/s' % (
+                    loader.rows_count, loader.copy_time + loader.merge_time,
+                    loader.rows_per_second
+                ))
+                prices_total = loader.result
+                stock_prices_parser = loader.parser
+                prices_writes = OrderedDict((
+                    ('rows', loader.rows_count),
+                    ('copy_time', loader.copy_time),
+                    ('merge_time', loader.merge_time)
+                ))
+            else:
+                stock_prices_parser = importer.import_stock_prices()
+                insider_trades_parser = importer.import_insider_trades()
+                stock_prices_parser.join_all()
+            insider_trades_parser.join_all()
+            importer.flush()
+            parsers = [stock_prices_parser, insider_trades_parser]
+            timings = OrderedDict((
+                ('prices', stock_prices_parser.timings),
+                ('insider_trades', insider_trades_parser.timings)
+            ))
+
+        totals = OrderedDict((
+            ('prices', prices_total or importer.prices_writer.total),
+            ('insider_trades', importer.trades_writer.total)
+        ))
+        stats = OrderedDict()
+        for kind, name in (('prices', 'Prices'), ('insider_trades', 'Insider trades')):
+            stats[kind] = get_task_stats(timings[kind])
+            self._write_total(name, totals[kind])
+            self._write_timings(name, stats[kind], timings[kind])
+        stats['writes'] = OrderedDict((
+            ('prices', prices_writes or importer.prices_writer.get_stats()),
+            ('insider_trades', importer.trades_writer.get_stats())
+        ))
+        for kind, name in (('prices', 'Prices'), ('insider_trades', 'Insider trades')):
+            self._write_write_stats(name, stats['writes'][kind])
+        if options['backend'] == 'pipeline':
+            self._write_pipeline_stats(pipeline)
+        failed = self._write_failures(importer, *parsers)
+        self._write_cache_stats()
+
+        stats['slowest'] = sorted(
+            get_stock_timings(timings['prices'] + timings['insider_trades']).items(),
+            key=lambda item: item[1], reverse=True
+        )[:20]
+        stats['failed'] = dict((slug, str(error)) for slug, error in failed.items())
+        ImportRun.objects.create(
+            started=started,
+            finished=timezone.now(),
+            backend=options['backend'],
+            loader=options['loader'],
+            incremental=options['incremental'],
+            tickers=len(importer.stocks),
+            failed_tickers=len(failed),
+            pages=stats['prices']['tasks'] + stats['insider_trades']['tasks'],
+            bytes=stats['prices']['bytes'] + stats['insider_trades']['bytes'],
+            rows_inserted=sum(total.inserted for total in totals.values()),
+            rows_updated=sum(total.updated for total in totals.values()),
+            rows_skipped=sum(total.skipped for total in totals.values()),
+            stats=stats
+        )
+        if failed:
+            self.stdout.write(self.style.WARNING('Import finished, %d tickers failed' % len(failed)))
+        else:
+            self.stdout.write(self.style.SUCCESS('Import finished'))
+
+    def _write_total(self, name, total):
+        self.stdout.write('%s: %d inserted, %d updated, %d skipped, %d stocks changed' % (
+            name, total.inserted, total.updated, total.skipped, len(total.changed)
+        ))
+
+    def _write_timings(self, name, stats, timings, slowest=5):
+        if not stats['tasks']:
+            return
+        self.stdout.write('%s tasks: %d, %d errors, %d rows, %.1f KB fetched' % (
+            name, stats['tasks'], stats['errors'], stats['rows'], stats['bytes'] / 1024
+        ))
+        for key in ('time', 'fetch_time', 'parse_time'):
+            self.stdout.write('  %-10s p50 %.3fs, p95 %.3fs, p99 %.3fs, max %.3fs' % (
+                key.replace('_', ' '), stats[key]['p50'], stats[key]['p95'], stats[key]['p99'],
+                stats[key]['max']
+            ))
+        stock_timings = sorted(
+            get_stock_timings(timings).items(), key=lambda item: item[1], reverse=True
+        )
+        self.stdout.write('%s slowest tickers: %s' % (name, ', '.join(
+            '%s %.2fs' % item for item in stock_timings[:slowest]
+        )))
+
+    def _write_write_stats(self, name, stats):
+        if not stats.get('batches'):
+            return
+        self.stdout.write('%s writes: %d batches, p50 %.3fs, p95 %.3fs, total %.2fs' % (
+            name, stats['batches'], stats['time']['p50'], stats['time']['p95'],
+            stats['time']['total']
+        ))
+
+    def _write_failures(self, *sources):
+        """
+        Tickers failed by the parsers (fetching) or by the importer (writing)
+        """
+        failed = {}
+        for source in sources:
+            failed.update(source.get_failed_stocks())
+        if failed:
+            self.stdout.write(self.style.WARNING('Failed tickers: %d' % len(failed)))
+            for stock_slug in sorted(failed):
+                self.stdout.write('  %s: %s' % (stock_slug, failed[stock_slug]))
+        return failed
 
-        stock_prices_parser.join_all()
-        insider_trades_parser.join_all()
+    def _write_cache_stats(self):
+        cache = get_response_cache()
+        if cache is not None:
+            self.stdout.write('HTTP cache: %d hits, %d revalidated, %d misses' % (
+                cache.hits, cache.revalidated, cache.misses
+            ))
 
-        self.stdout.write(self.style.SUCCESS('Import finished'))
+    def _write_pipeline_stats(self, pipeline):
+        self.stdout.write('Pipeline finished in %.2fs' % pipeline.elapsed)
+        for stage in pipeline.stages.values():
+            self.stdout.write(
+                'Stage %s: %d pages, %d rows, busy %.2fs, %.1f pages/s' % (
+                    stage.name, stage.items, stage.rows, stage.busy_time,
+                    stage.items / pipeline.elapsed if pipeline.elapsed else 0
+                )
+            )
+        for name in pipeline.queues:
+            self.stdout.write('Queue %s: max %d, avg %.1f' % (
+                (name,) + pipeline.get_queue_depth(name)
+            ))
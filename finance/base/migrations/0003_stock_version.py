@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_stockprice_stock_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
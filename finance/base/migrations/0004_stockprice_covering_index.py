@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:37
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_stock_version'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='stockprice',
+            index_together=set([('stock', 'date', 'open', 'high', 'low', 'close')]),
+        ),
+    ]
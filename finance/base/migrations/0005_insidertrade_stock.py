@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_stockprice_covering_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='insidertrade',
+            name='stock',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='insider_trades', to='base.Stock'),
+        ),
+        migrations.RunSQL(
+            'UPDATE base_insidertrade t SET stock_id = i.stock_id '
+            'FROM base_insider i WHERE i.id = t.insider_id',
+            migrations.RunSQL.noop
+        ),
+        migrations.AlterField(
+            model_name='insidertrade',
+            name='stock',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='insider_trades', to='base.Stock'),
+        ),
+        migrations.AlterIndexTogether(
+            name='insidertrade',
+            index_together=set([('stock', 'date', 'id')]),
+        ),
+    ]
@@ -1,8 +1,28 @@
-from django.db import models, IntegrityError
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import models, connection, connections
+from django.contrib.postgres.fields import JSONField
+
+from .db import bulk_upsert, merge_from
+from .utils import LRUCache
+
+
+class StockQuerySet(models.QuerySet):
+    def bump_versions(self, ids):
+        """
+        Invalidates cached API responses of the stocks
+        """
+        if ids:
+            self.filter(id__in=ids).update(version=models.F('version') + 1)
 
 
 class Stock(models.Model):
     slug = models.SlugField(unique=True)
+    # Incremented when prices or insider trades of the stock change
+    version = models.PositiveIntegerField(default=0)
+
+    objects = StockQuerySet.as_manager()
 
     @models.permalink
     def get_absolute_url(self):
@@ -11,9 +31,168 @@ class Stock(models.Model):
 
 STOCK_PRICE_TYPES = ('open', 'high', 'low', 'close')
 
+STOCK_PRICE_COLUMNS = ('date', 'stock_id') + STOCK_PRICE_TYPES + ('volume',)
+
+
+DELTA_SQL = """
+WITH RECURSIVE periods AS (
+    (
+        SELECT date, {column} AS value, NULL::date AS date_from, NULL::numeric AS delta
+        FROM {table}
+        WHERE stock_id = %(stock)s AND {column} IS NOT NULL
+        ORDER BY date
+        LIMIT 1
+    )
+    UNION ALL
+    SELECT found.date, found.value, periods.date, found.value - periods.value
+    FROM periods, LATERAL (
+        SELECT date, {column} AS value
+        FROM {table}
+        WHERE stock_id = %(stock)s AND date > periods.date AND {column} IS NOT NULL
+            AND abs({column} - periods.value) > %(max_delta)s
+        ORDER BY date
+        LIMIT 1
+    ) found
+)
+SELECT date_from, date, delta FROM periods WHERE date_from IS NOT NULL ORDER BY date
+"""
+
+# (stock id, stock version, type, max delta) => delta periods
+delta_cache = LRUCache(settings.DELTA_CACHE_SIZE)
+
+
+def get_delta_periods(series, max_deltas):
+    """
+    StockPriceQuerySet.delta periods for several thresholds in one pass
+
+    @type :series: iterable of (date, value) ordered by date
+    @type :max_deltas: iterable of int
+    @rtype: dict, max_delta => list of dicts with date_from, date_to and delta
+    """
+    result = dict((max_delta, []) for max_delta in max_deltas)
+    starts = None
+    for date, value in series:
+        if starts is None:
+            starts = dict((max_delta, (date, value)) for max_delta in result)
+            continue
+        for max_delta, (start_date, start_value) in starts.items():
+            delta = value - start_value
+            if abs(delta) > max_delta:
+                result[max_delta].append({
+                    'date_from': start_date, 'date_to': date, 'delta': delta
+                })
+                starts[max_delta] = (date, value)
+    return result
+
+
+PERIOD_CHANGE_COLUMNS = tuple(
+    '%s_%s' % (type_, suffix)
+    for type_ in STOCK_PRICE_TYPES for suffix in ('from', 'to', 'change', 'percent')
+)
+
+PERIOD_CHANGES_SQL = """
+WITH bounds AS (
+    SELECT stock_id, min(date) AS date_from, max(date) AS date_to
+    FROM {table}
+    WHERE date >= %(date_from)s AND date <= %(date_to)s {stocks}
+    GROUP BY stock_id
+)
+SELECT * FROM (
+    SELECT stock.slug, bounds.date_from, bounds.date_to, {columns}
+    FROM bounds
+    JOIN {table} first_price
+        ON first_price.stock_id = bounds.stock_id AND first_price.date = bounds.date_from
+    JOIN {table} last_price
+        ON last_price.stock_id = bounds.stock_id AND last_price.date = bounds.date_to
+    JOIN {stock_table} stock ON stock.id = bounds.stock_id
+) changes
+{where}
+ORDER BY {order} NULLS LAST, slug
+LIMIT %(limit)s
+"""
+
+ANALYTICS_SQL = """
+SELECT * FROM (
+    SELECT *, {deltas}
+    FROM {table}
+    WHERE stock_id = %(stock)s AND date <= %(date_to)s AND date >= COALESCE(
+        (SELECT max(date) FROM {table} WHERE stock_id = %(stock)s AND date < %(date_from)s),
+        %(date_from)s
+    )
+    WINDOW previous AS (ORDER BY date)
+) prices
+WHERE date >= %(date_from)s
+ORDER BY date
+"""
+
 
 class StockPriceQuerySet(models.QuerySet):
     def delta(self, stock, max_delta, type_):
+        """
+        Minimal periods when the type_ price changed more than max_delta,
+        computed in PostgreSQL: starting from the first price each period
+        ends at the first following price which differs from the period's
+        first price by more than max_delta. Each period end is found by a
+        (stock, date) index scan from the period start, so the series is
+        read about once. python_delta is the reference.
+
+        @rtype: list of dicts with date_from, date_to and delta
+        """
+        assert isinstance(stock, Stock)
+        assert isinstance(max_delta, int)
+        assert type_ in STOCK_PRICE_TYPES
+
+        connection = connections[self.db]
+        sql = DELTA_SQL.format(
+            table=connection.ops.quote_name(self.model._meta.db_table),
+            column=connection.ops.quote_name(type_)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'stock': stock.id, 'max_delta': max_delta})
+            return [
+                {'date_from': date_from, 'date_to': date_to, 'delta': delta}
+                for date_from, date_to, delta in cursor.fetchall()
+            ]
+
+    def deltas(self, stock, max_deltas, type_, store=None):
+        """
+        delta() for several thresholds, memoized until the stock version
+        changes. Several missing thresholds are computed in one pass over
+        the prices instead of a query per threshold.
+
+        @type :max_deltas: list of int
+        @type :store: None | PriceStore, compute missing thresholds from its series
+        @rtype: dict, max_delta => delta() result
+        """
+        assert isinstance(stock, Stock)
+        assert all(isinstance(max_delta, int) for max_delta in max_deltas)
+        assert type_ in STOCK_PRICE_TYPES
+
+        key = (stock.id, stock.version, type_)
+        result = {}
+        for max_delta in max_deltas:
+            periods = delta_cache.get(key + (max_delta,))
+            if periods is not None:
+                result[max_delta] = periods
+        missing = set(max_deltas) - set(result)
+        if missing and store is not None:
+            computed = store.get(stock).deltas(missing, type_)
+        elif len(missing) == 1:
+            max_delta, = missing
+            computed = {max_delta: self.delta(stock, max_delta, type_)}
+        elif missing:
+            series = self.filter(
+                stock=stock, **{'%s__isnull' % type_: False}
+            ).order_by('date').values_list('date', type_)
+            computed = get_delta_periods(series.iterator(), missing)
+        else:
+            computed = {}
+        for max_delta, periods in computed.items():
+            delta_cache.set(key + (max_delta,), periods)
+        result.update(computed)
+        return result
+
+    def python_delta(self, stock, max_delta, type_):
         assert isinstance(stock, Stock)
         assert isinstance(max_delta, int)
         assert type_ in STOCK_PRICE_TYPES
@@ -44,19 +223,123 @@ class StockPriceQuerySet(models.QuerySet):
             last_value = stock_price[type_]
         return result
 
+    def latest_dates(self):
+        """
+        @rtype: dict, stock id => date of the latest price
+        """
+        return dict(
+            self.order_by().values('stock').annotate(latest=models.Max('date'))
+            .values_list('stock', 'latest')
+        )
+
+    def upsert(self, prices, update=True):
+        """
+        @type :prices: list of dicts with StockPrice fields and stock_id
+        @type :update: bool, update changed prices of existing rows
+        @rtype: UpsertResult, changed are stock ids
+        """
+        fields = STOCK_PRICE_COLUMNS
+        rows = OrderedDict(
+            ((p['date'], p['stock_id']), tuple(p[f] for f in fields)) for p in prices
+        )
+        result = bulk_upsert(
+            self.model, fields, list(rows.values()), ('date', 'stock_id'),
+            update_fields=fields[2:] if update else None, returning='stock_id'
+        )
+        return result._replace(skipped=result.skipped + len(prices) - len(rows))
+
+    def merge_from(self, table, update=True):
+        """
+        Upsert prices from a table with STOCK_PRICE_COLUMNS columns
+
+        @type :table: str
+        @rtype: UpsertResult, changed are stock ids
+        """
+        return merge_from(
+            self.model, STOCK_PRICE_COLUMNS, table, ('date', 'stock_id'),
+            update_fields=STOCK_PRICE_COLUMNS[2:] if update else None, returning='stock_id'
+        )
+
     def in_period(self, date_from, date_to):
         return self.filter(date__gte=date_from, date__lte=date_to)
 
-    def with_previous(self):
-        queryset = self.order_by('date')
-        last_stock_price = None
-        for stock_price in queryset:
-            if last_stock_price is None:
-                last_stock_price = stock_price
-                continue
-            stock_price._previous_row = last_stock_price
-            last_stock_price = stock_price
-        return queryset
+    def period_changes(self, date_from, date_to, slugs=None, order='-close_percent',
+                       min_value=None, max_value=None, limit=None):
+        """
+        Prices change of every stock between its first and last day of the
+        period, in one query. Rows are ranked by order, a PERIOD_CHANGE_COLUMNS
+        name with an optional '-' for descending, and filtered by its value.
+
+        @type :slugs: None | list, all stocks by default
+        @rtype: list of dicts with slug, date_from, date_to and PERIOD_CHANGE_COLUMNS
+        """
+        order_column = order.lstrip('-')
+        assert order_column in PERIOD_CHANGE_COLUMNS
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        columns = []
+        for type_ in STOCK_PRICE_TYPES:
+            column = qn(type_)
+            columns += [
+                'first_price.{0} AS {1}_from'.format(column, type_),
+                'last_price.{0} AS {1}_to'.format(column, type_),
+                'last_price.{0} - first_price.{0} AS {1}_change'.format(column, type_),
+                'round((last_price.{0} - first_price.{0}) / NULLIF(first_price.{0}, 0) * 100, 4) '
+                'AS {1}_percent'.format(column, type_)
+            ]
+        where = []
+        if min_value is not None:
+            where.append('%s >= %%(min_value)s' % order_column)
+        if max_value is not None:
+            where.append('%s <= %%(max_value)s' % order_column)
+        sql = PERIOD_CHANGES_SQL.format(
+            table=qn(self.model._meta.db_table),
+            stock_table=qn(Stock._meta.db_table),
+            stocks=(
+                'AND stock_id IN (SELECT id FROM %s WHERE slug = ANY(%%(slugs)s))'
+                % qn(Stock._meta.db_table) if slugs is not None else ''
+            ),
+            columns=', '.join(columns),
+            where='WHERE %s' % ' AND '.join(where) if where else '',
+            order='%s%s' % (order_column, ' DESC' if order.startswith('-') else '')
+        )
+        params = {
+            'date_from': date_from, 'date_to': date_to, 'slugs': slugs,
+            'min_value': min_value, 'max_value': max_value, 'limit': limit
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def analytics(self, stock, date_from, date_to):
+        """
+        Prices of the period with open_delta, high_delta, low_delta and
+        close_delta, the change since the previous trading day, computed
+        with LAG() in one query. The first day of the period is compared
+        with the latest price before it.
+
+        @rtype: list of StockPrice
+        """
+        assert isinstance(stock, Stock)
+
+        connection = connections[self.db]
+        sql = ANALYTICS_SQL.format(
+            table=connection.ops.quote_name(self.model._meta.db_table),
+            deltas=', '.join(
+                '{0} - LAG({0}) OVER previous AS {1}'.format(
+                    connection.ops.quote_name(type_), '%s_delta' % type_
+                )
+                for type_ in STOCK_PRICE_TYPES
+            )
+        )
+        prices = list(self.raw(
+            sql, {'stock': stock.id, 'date_from': date_from, 'date_to': date_to}
+        ))
+        for price in prices:
+            price.stock = stock
+        return prices
 
 
 class StockPrice(models.Model):
@@ -68,41 +351,56 @@ class StockPrice(models.Model):
     volume = models.PositiveIntegerField(null=True)
     stock = models.ForeignKey(Stock, related_name='prices', on_delete=models.CASCADE)
 
+    # Set by StockPrice.objects.analytics()
+    open_delta = None
+    high_delta = None
+    low_delta = None
+    close_delta = None
+
     objects = StockPriceQuerySet.as_manager()
 
     class Meta:
         unique_together = ('date', 'stock')
+        # Covers the per stock range, analytics and delta scans
+        index_together = ('stock', 'date', 'open', 'high', 'low', 'close')
         ordering = ['-date']
 
-    @property
-    def open_delta(self):
-        return self._get_delta('open')
 
-    @property
-    def high_delta(self):
-        return self._get_delta('high')
-
-    @property
-    def low_delta(self):
-        return self._get_delta('low')
-
-    @property
-    def close_delta(self):
-        return self._get_delta('close')
-
-    def _get_delta(self, field_name):
-        if hasattr(self, '_previous_row'):
-            return getattr(self, field_name) - getattr(self._previous_row, field_name)
-        return None
+class InsiderManager(models.Manager):
+    def resolve(self, keys):
+        """
+        Get or create insiders for all (name, stock_id) pairs in one query
 
+        @type :keys: iterable of (name, stock_id)
+        @rtype: dict, (name, stock_id) => insider id
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        sql = (
+            'WITH input (name, stock_id) AS (VALUES %s), '
+            'created AS ('
+            'INSERT INTO {table} (name, stock_id) SELECT name, stock_id FROM input '
+            'ON CONFLICT (name, stock_id) DO NOTHING RETURNING id, name, stock_id'
+            ') '
+            'SELECT id, name, stock_id FROM created '
+            'UNION ALL '
+            'SELECT i.id, i.name, i.stock_id FROM {table} i JOIN input USING (name, stock_id)'
+        ).format(table=table) % ', '.join(['(%s::varchar, %s::integer)'] * len(keys))
+        with connection.cursor() as cursor:
+            # Sorted, so concurrent writers lock new keys in the same order
+            cursor.execute(sql, [value for key in sorted(keys) for value in key])
+            result = {(name, stock_id): id_ for id_, name, stock_id in cursor.fetchall()}
 
-class InsiderManager(models.Manager):
-    def safety_get_or_create(self, **kwargs):
-        try:
-            instance = self.create(**kwargs)
-        except IntegrityError:
-            instance = self.get(**kwargs)
-        return instance
+        # Rows inserted by a concurrent transaction are not visible to the
+        # statement snapshot above
+        missing = keys - set(result)
+        if missing:
+            for insider in self.filter(stock_id__in=set(k[1] for k in missing),
+                                       name__in=set(k[0] for k in missing)):
+                result[(insider.name, insider.stock_id)] = insider.id
+        return result
 
 
 class Insider(models.Model):
@@ -118,9 +416,40 @@ class Insider(models.Model):
         return self.name
 
 
+class InsiderTradeQuerySet(models.QuerySet):
+    def latest_dates(self):
+        """
+        @rtype: dict, stock id => date of the latest trade
+        """
+        return dict(
+            self.order_by().values('stock').annotate(latest=models.Max('date'))
+            .values_list('stock', 'latest')
+        )
+
+    def upsert(self, trades):
+        """
+        Existing trades are skipped, they have nothing to update
+
+        @type :trades: list of dicts with InsiderTrade fields, insider_id and stock_id
+        @rtype: UpsertResult, changed are stock ids
+        """
+        fields = (
+            'date', 'insider_id', 'stock_id', 'relation', 'transaction_type', 'owner_type',
+            'shares_traded', 'last_price', 'shares_held'
+        )
+        return bulk_upsert(
+            self.model, fields, [tuple(t[f] for f in fields) for t in trades],
+            ('insider_id', 'date', 'transaction_type', 'shares_traded', 'last_price',
+             'shares_held'),
+            returning='stock_id'
+        )
+
+
 class InsiderTrade(models.Model):
     date = models.DateField()
     insider = models.ForeignKey(Insider, related_name='trades', on_delete=models.CASCADE)
+    # Same as insider.stock, saves the join for trades of a stock
+    stock = models.ForeignKey(Stock, related_name='insider_trades', on_delete=models.CASCADE)
     relation = models.CharField(max_length=255)
     transaction_type = models.CharField(max_length=255)
     owner_type = models.CharField(max_length=255)
@@ -128,9 +457,45 @@ class InsiderTrade(models.Model):
     last_price = models.DecimalField(max_digits=10, decimal_places=4, null=True)
     shares_held = models.PositiveIntegerField(null=True)
 
+    objects = InsiderTradeQuerySet.as_manager()
+
     class Meta:
         unique_together = (
             'insider', 'date', 'transaction_type', 'shares_traded', 'last_price',
             'shares_held'
         )
+        # Trades of a stock in the (date, id) order of the API keyset pagination
+        index_together = ('stock', 'date', 'id')
         ordering = ['-date']
+
+
+class ImportRun(models.Model):
+    """
+    An import_data run, stats holds the totals and percentiles of the parser
+    tasks per kind (get_task_stats), of the DB writes and the slowest tickers
+    """
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    backend = models.CharField(max_length=32)
+    loader = models.CharField(max_length=32)
+    incremental = models.BooleanField(default=False)
+    tickers = models.PositiveIntegerField(default=0)
+    failed_tickers = models.PositiveIntegerField(default=0)
+    pages = models.PositiveIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    rows_inserted = models.PositiveIntegerField(default=0)
+    rows_updated = models.PositiveIntegerField(default=0)
+    rows_skipped = models.PositiveIntegerField(default=0)
+    stats = JSONField(default=dict)
+
+    class Meta:
+        ordering = ['-started']
+
+    @property
+    def elapsed(self):
+        return (self.finished - self.started).total_seconds()
+
+    @property
+    def rows_per_second(self):
+        rows = self.rows_inserted + self.rows_updated + self.rows_skipped
+        return rows / self.elapsed if self.elapsed else None
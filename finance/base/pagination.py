@@ -0,0 +1,130 @@
+import json
+import base64
+
+from django.db import connections
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage(object):
+    """
+    @type :object_list: list
+    @type :next_cursor: None | str
+    @type :previous_cursor: None | str
+    """
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset in descending order of fields (unique together
+    within the queryset) by the values of the page bounds instead of an
+    offset, so with an index on the queryset filter and the fields every
+    page is an index range scan and no COUNT(*) is needed.
+    Cursors are opaque url safe strings with a bound and a direction.
+
+    @type :queryset: QuerySet
+    @type :fields: tuple of field names
+    @type :page_size: int
+    @type :key: None | (row) => tuple of fields values, for values_list querysets
+    """
+
+    def __init__(self, queryset, fields, page_size, key=None):
+        assert isinstance(page_size, int) and page_size > 0
+        assert callable(key) or key is None
+
+        self.queryset = queryset
+        self.fields = [queryset.model._meta.get_field(name) for name in fields]
+        self.page_size = page_size
+        self.key = key
+
+    def get_page(self, cursor=None):
+        """
+        @type :cursor: None | str
+        @rtype: KeysetPage
+        """
+        position, reverse = self.decode_cursor(cursor) if cursor else (None, False)
+        queryset = self.queryset
+        if position is not None:
+            queryset = self._filter(queryset, position, reverse)
+        ordering = [('' if reverse else '-') + field.name for field in self.fields]
+        object_list = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(object_list) > self.page_size
+        object_list = object_list[:self.page_size]
+        if reverse:
+            object_list.reverse()
+
+        next_cursor = previous_cursor = None
+        if object_list:
+            if has_more or reverse:
+                next_cursor = self.encode_cursor(self._get_position(object_list[-1]), False)
+            if position is not None and (has_more or not reverse):
+                previous_cursor = self.encode_cursor(self._get_position(object_list[0]), True)
+        elif position is not None:
+            # Nothing beyond the bound, link back to the rows before it
+            if reverse:
+                next_cursor = self.encode_cursor(position, False)
+            else:
+                previous_cursor = self.encode_cursor(position, True)
+        return KeysetPage(object_list, next_cursor, previous_cursor)
+
+    def iterate(self):
+        """
+        Yields object lists of all pages, one index range scan per page
+        """
+        position = None
+        while True:
+            queryset = self.queryset
+            if position is not None:
+                queryset = self._filter(queryset, position, False)
+            ordering = ['-' + field.name for field in self.fields]
+            object_list = list(queryset.order_by(*ordering)[:self.page_size])
+            if object_list:
+                yield object_list
+            if len(object_list) < self.page_size:
+                return
+            position = self._get_position(object_list[-1])
+
+    def encode_cursor(self, position, reverse):
+        data = json.dumps({'p': position, 'r': reverse}, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """
+        @rtype: (position, reverse)
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            values = data['p']
+            if len(values) != len(self.fields):
+                raise ValueError('Wrong cursor length')
+            position = tuple(field.to_python(value) for field, value in zip(self.fields, values))
+            return position, bool(data['r'])
+        except (TypeError, ValueError, KeyError, ValidationError) as e:
+            raise InvalidCursor(str(e))
+
+    def _get_position(self, obj):
+        if self.key is not None:
+            return self.key(obj)
+        return tuple(getattr(obj, field.attname) for field in self.fields)
+
+    def _filter(self, queryset, position, reverse):
+        """
+        A row comparison, (date, id) < (%s, %s), is matched to the index by PostgreSQL
+        """
+        quote_name = connections[queryset.db].ops.quote_name
+        table = quote_name(queryset.model._meta.db_table)
+        where = '(%s) %s (%s)' % (
+            ', '.join('%s.%s' % (table, quote_name(field.column)) for field in self.fields),
+            '>' if reverse else '<',
+            ', '.join(['%s'] * len(self.fields))
+        )
+        return queryset.extra(where=[where], params=list(position))
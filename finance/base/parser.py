@@ -1,41 +1,95 @@
+import re
+import time
+import random
 import requests
 import logging
 
 from decimal import Decimal, InvalidOperation
-from threading import Thread
-from datetime import datetime, date
+from queue import Queue
+from threading import Thread, local
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+from collections import namedtuple
+from datetime import date
+from urllib.parse import urljoin
+from lxml.etree import XPath
 from lxml.html import fromstring
-from .utils import split_list
 
-from django.utils.lru_cache import lru_cache
+from django.conf import settings
+from django.db import connection
+
+from .http_cache import get_response_cache
 
 logger = logging.getLogger(__name__)
 
 
+PRICES = 'prices'
+INSIDER_TRADES = 'insider_trades'
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Order of the values of rows packed into tuples, the stock is not packed
+ROW_FIELDS = {
+    PRICES: ('date', 'open', 'high', 'low', 'close', 'volume'),
+    INSIDER_TRADES: (
+        'insider', 'relation', 'date', 'transaction_type', 'owner_type', 'shares_traded',
+        'last_price', 'shares_held'
+    )
+}
+
+PRICE_ROWS = XPath('//*[@id="quotes_content_left_pnlAJAX"]/table/tbody/tr')
+TRADE_ROWS = XPath('//div[@class="genTable"]/table[@class="certain-width"]/tr')
+PAGER_LINKS = XPath('//ul[@class="pager"]//a[@class="pagerlink"]/@href')
+
+# (start marker, end tag) of the page parts the XPaths above look into
+PRICES_REGIONS = (('id="quotes_content_left_pnlAJAX"', '</table>'),)
+INSIDER_TRADES_REGIONS = (('class="genTable"', '</table>'), ('class="pager"', '</ul>'))
+
+_local = local()
+
+
 class ParserError(Exception):
     pass
 
 
 class ThreadedParser(object):
     """
+    Workers pull the next task from a shared queue as soon as they are free.
+    A task returns parsed rows and follow-up tasks (e.g. insider trades
+    pages), which are put to the same queue.
+
     @type :parser: stock_prices_parser | insider_trades_parser
     @type :stocks: list
     @type :thread_number: int
     @type :callback: None | callable
+    @type :watermarks: None | dict, stock slug => date of the latest stored row
+    @type :parse_pool: None | ProcessPoolExecutor, pages are parsed in the
+        worker threads without it
+    @type :timings: list of TaskTiming
     """
     result = None
     threads = None
+    timings = None
+    cancelled = False
 
-    def __init__(self, parser, stocks, thread_number=1, callback=None):
+    def __init__(self, parser, stocks, thread_number=1, callback=None, watermarks=None,
+                 parse_pool=None):
         assert (parser is stock_prices_parser) or (parser is insider_trades_parser)
         assert isinstance(stocks, list)
         assert isinstance(thread_number, int)
         assert callable(callback) or callback is None
+        assert isinstance(watermarks, dict) or watermarks is None
 
         self.result = []
+        self.timings = []
+        self.callback = callback
+        self.parse_pool = parse_pool
+        self.queue = Queue()
+        for stock_slug in stocks:
+            self.queue.put((parser, (stock_slug, (watermarks or {}).get(stock_slug))))
         self.threads = [
-            Thread(target=parser, args=(slugs, self.result, callback))
-            for slugs in split_list(stocks, thread_number)
+            Thread(target=self._worker) for _ in range(min(thread_number, len(stocks)))
         ]
 
     def start_all(self):
@@ -43,28 +97,168 @@ class ThreadedParser(object):
             thread.start()
 
     def join_all(self):
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
         for thread in self.threads:
             thread.join()
 
+    def cancel(self):
+        """
+        Tasks not started yet are skipped, so join_all returns once the
+        running ones finish
+        """
+        self.cancelled = True
+
+    def get_failed_stocks(self):
+        return get_failed_stocks(self.timings)
+
+    def _worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                # Callbacks write rows from the worker, close its connection
+                connection.close()
+                self.queue.task_done()
+                break
+            try:
+                self._run(*task)
+            except Exception:
+                logger.exception('Parser task error, %s%r', task[0].__name__, task[1])
+            finally:
+                self.queue.task_done()
+
+    def _run(self, parser, args):
+        if self.cancelled:
+            return
+        _local.fetch_stats = [0, 0]
+        _local.parse_pool = self.parse_pool
+        started = time.time()
+        try:
+            rows, tasks = parser(*args)
+        except Exception as e:
+            self.timings.append(TaskTiming(
+                args[0], parser.__name__, time.time() - started, e, *_local.fetch_stats
+            ))
+            raise
+        timing = TaskTiming(
+            args[0], parser.__name__, time.time() - started, None, *_local.fetch_stats,
+            rows=len(rows)
+        )
+        for task in tasks:
+            self.queue.put(task)
+        try:
+            if callable(self.callback):
+                self.callback(rows)
+            else:
+                self.result.append(rows)
+        except Exception as e:
+            # Rows not handed over fail the task as a fetch error does
+            timing = timing._replace(error=e)
+            raise
+        finally:
+            self.timings.append(timing)
+
+
+class TaskTiming(namedtuple('TaskTiming', (
+    'stock', 'task', 'time', 'error', 'fetch_time', 'bytes', 'rows'
+))):
+    """
+    @type :time: float, seconds of the whole task
+    @type :error: None | Exception
+    @type :fetch_time: float, seconds of getting pages, from the network or the cache
+    @type :bytes: int, size of the fetched pages in characters
+    @type :rows: int, parsed rows
+    """
+    __slots__ = ()
 
-def stock_prices_parser(stock_slugs, result, callback=None):
-    for stock_slug in stock_slugs:
-        print('Prices', stock_slug)
-        prices = NasdaqPricesParser(stock_slug).get_stock_prices()
-        if callable(callback):
-            callback(prices)
-        else:
-            result.append(prices)
+    @property
+    def parse_time(self):
+        return self.time - self.fetch_time
 
 
-def insider_trades_parser(stock_slugs, result, callback=None):
-    for stock_slug in stock_slugs:
-        print('Insiders', stock_slug)
-        trades = NasdaqInsiderTradesParser(stock_slug).get_insider_trades()
-        if callable(callback):
-            callback(trades)
-        else:
-            result.append(trades)
+TaskTiming.__new__.__defaults__ = (0, 0, 0)
+
+
+def get_failed_stocks(timings):
+    """
+    @type :timings: list of TaskTiming
+    @rtype: dict, stock slug => last error
+    """
+    return dict((t.stock, t.error) for t in timings if t.error is not None)
+
+
+def get_stock_timings(timings):
+    """
+    @type :timings: list of TaskTiming
+    @rtype: dict, stock slug => seconds spent on all its tasks
+    """
+    result = {}
+    for timing in timings:
+        result[timing.stock] = result.get(timing.stock, 0) + timing.time
+    return result
+
+
+def stock_prices_parser(stock_slug, watermark=None):
+    logger.debug('Prices %s', stock_slug)
+    parser = NasdaqPricesParser(stock_slug)
+    rows, _ = _parse(PRICES, stock_slug, parser._get_html_string())
+    return rows, ()
+
+
+def insider_trades_parser(stock_slug, watermark=None):
+    """
+    Without a watermark all pages are queued at once, with a watermark pages
+    are fetched one by one until a page has no trades newer than it
+    """
+    logger.debug('Insider trades %s', stock_slug)
+    parser = NasdaqInsiderTradesParser(stock_slug)
+    rows, urls = _parse(INSIDER_TRADES, stock_slug, parser._get_html_string(parser.url))
+    if watermark is None:
+        tasks = [(insider_trades_page_parser, (stock_slug, url)) for url in urls]
+    else:
+        tasks = _get_next_page_tasks(stock_slug, rows, urls, watermark)
+    return rows, tasks
+
+
+def insider_trades_page_parser(stock_slug, url, watermark=None, next_urls=()):
+    logger.debug('Insider trades %s %s', stock_slug, url)
+    html = NasdaqInsiderTradesParser(stock_slug)._get_html_string(url)
+    rows, _ = _parse(INSIDER_TRADES, stock_slug, html, first_page=False)
+    return rows, _get_next_page_tasks(stock_slug, rows, next_urls, watermark)
+
+
+def has_new_trades(trades, watermark):
+    """
+    Trades are listed newest first, so a page without trades newer than the
+    latest stored one means the following pages are already stored too
+    """
+    return watermark is None or any(trade['date'] > watermark for trade in trades)
+
+
+def _parse(kind, stock_slug, html, first_page=True):
+    """
+    Parses a fetched page in the parse pool of the ThreadedParser running
+    the task if it has one
+
+    @rtype: (rows, following pages urls)
+    """
+    pool = getattr(_local, 'parse_pool', None)
+    if pool is None:
+        rows, urls, _ = parse_page(kind, stock_slug, html, first_page)
+        return rows, urls
+    [(rows, urls, _, error)] = pool.submit(
+        parse_pages, [(kind, stock_slug, html, first_page)]
+    ).result()
+    if error is not None:
+        raise error
+    return unpack_rows(kind, stock_slug, rows), urls
+
+
+def _get_next_page_tasks(stock_slug, rows, urls, watermark):
+    if not urls or not has_new_trades(rows, watermark):
+        return ()
+    return [(insider_trades_page_parser, (stock_slug, urls[0], watermark, urls[1:]))]
 
 
 def parse_tickers_file(path):
@@ -78,11 +272,14 @@ class NasdaqPricesParser(object):
 
     def __init__(self, stock_slug):
         self.stock_slug = stock_slug
-        self.url = 'http://www.nasdaq.com/symbol/%s/historical' % stock_slug
+        self.url = '%s/symbol/%s/historical' % (settings.NASDAQ_URL, stock_slug)
 
     def get_stock_prices(self):
+        return self.parse_stock_prices(self._get_html_string())
+
+    def parse_stock_prices(self, html):
         rows = []
-        for row in self._get_raw_rows():
+        for row in PRICE_ROWS(parse_regions(html, PRICES_REGIONS, PRICE_ROWS)):
             if len(row) != 6:
                 continue
             rows.append({
@@ -96,18 +293,8 @@ class NasdaqPricesParser(object):
             })
         return rows
 
-    def _get_raw_rows(self):
-        items = fromstring(self._get_html_string()).xpath(
-            '//*[@id="quotes_content_left_pnlAJAX"]/table/tbody/tr'
-        )
-        return items
-
     def _get_html_string(self):
-        response = requests.get(self.url)
-        if response.status_code != 200:
-            logger.debug('Parser GET error, %s' % url)
-            raise ParserError('Parser GET error, %s' % self.url)
-        return response.text
+        return get_html_string(self.url)
 
 
 class NasdaqInsiderTradesParser(object):
@@ -117,57 +304,272 @@ class NasdaqInsiderTradesParser(object):
 
     def __init__(self, stock_slug):
         self.stock_slug = stock_slug
-        self.url = 'http://www.nasdaq.com/symbol/%s/insider-trades' % stock_slug
+        self.url = '%s/symbol/%s/insider-trades' % (settings.NASDAQ_URL, stock_slug)
 
     def get_insider_trades(self):
+        rows, urls = self.parse_page(self._get_html_string(self.url))
+        for url in urls:
+            rows.extend(self.get_insider_trades_page(url))
+        return rows
+
+    def get_insider_trades_page(self, url):
+        return self.parse_insider_trades(self._get_html_string(url))
+
+    def parse_page(self, html):
+        """
+        Trades and following pages urls of the first page, parsed once
+
+        @rtype: (list of dicts, list of urls)
+        """
+        tree = parse_regions(html, INSIDER_TRADES_REGIONS, TRADE_ROWS)
+        return self._get_trades(tree), self._get_pages_urls(tree)
+
+    def parse_insider_trades(self, html):
+        return self._get_trades(parse_regions(html, INSIDER_TRADES_REGIONS, TRADE_ROWS))
+
+    def _get_trades(self, tree):
         rows = []
-        for url in self._get_pages_urls():
-            for row in self._get_raw_rows(url):
-                if len(row) != 8:
-                    continue
-                rows.append({
-                    'insider': _normalize_value(row[0][0]),
-                    'relation': _normalize_value(row[1]),
-                    'date': _normalize_date(_normalize_value(row[2])),
-                    'transaction_type': _normalize_value(row[3]),
-                    'owner_type': _normalize_value(row[4]),
-                    'shares_traded': _normalize_integer(_normalize_value(row[5])),
-                    'last_price': _normalize_decimal(_normalize_value(row[6])),
-                    'shares_held': _normalize_integer(_normalize_value(row[7])),
-                    'stock': self.stock_slug
-                })
+        for row in TRADE_ROWS(tree):
+            if len(row) != 8:
+                continue
+            rows.append({
+                'insider': _normalize_value(row[0][0]),
+                'relation': _normalize_value(row[1]),
+                'date': _normalize_date(_normalize_value(row[2])),
+                'transaction_type': _normalize_value(row[3]),
+                'owner_type': _normalize_value(row[4]),
+                'shares_traded': _normalize_integer(_normalize_value(row[5])),
+                'last_price': _normalize_decimal(_normalize_value(row[6])),
+                'shares_held': _normalize_integer(_normalize_value(row[7])),
+                'stock': self.stock_slug
+            })
         return rows
 
-    def _get_pages_urls(self):
-        raw_urls = fromstring(self._get_html_string(self.url)).xpath(
-            '//ul[@class="pager"]//a[@class="pagerlink"]'
-        )
-        urls = list(set((ru.attrib['href'] for ru in raw_urls)))[:self.MAX_PAGES - 1]
-        urls.append(self.url)
-        return urls
+    def _get_pages_urls(self, tree):
+        urls = set(urljoin(self.url, href) for href in PAGER_LINKS(tree))
+        urls.discard(self.url)
+        return sorted(
+            (url for url in urls if _get_page_number(url) > 1), key=_get_page_number
+        )[:self.MAX_PAGES - 1]
+
+    def _get_html_string(self, url):
+        return get_html_string(url)
+
+
+def get_html_string(url):
+    """
+    GET with the worker thread's keep-alive session, retrying connection
+    errors, timeouts and RETRY_STATUSES with exponential backoff and jitter.
+    Responses are cached on disk and revalidated with conditional requests.
+    Time and size are added to the fetch stats of the ThreadedParser task.
+    """
+    started = time.time()
+    html = _get_html_string(url)
+    stats = getattr(_local, 'fetch_stats', None)
+    if stats is not None:
+        stats[0] += time.time() - started
+        stats[1] += len(html)
+    return html
+
+
+def _get_html_string(url):
+    cache = get_response_cache()
+    entry = cache.get(url) if cache else None
+    if entry is not None and cache.is_fresh(entry):
+        cache.count('hits')
+        return entry.body
+
+    session = get_session()
+    headers = get_conditional_headers(entry)
+    attempt = 0
+    while True:
+        try:
+            response = session.get(url, headers=headers, timeout=settings.PARSER_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = ParserError('Parser GET error, %s: %s' % (url, e))
+        else:
+            if response.status_code == 304 and entry is not None:
+                cache.count('revalidated')
+                cache.touch(url, entry)
+                return entry.body
+            if response.status_code == 200:
+                if cache:
+                    cache.count('misses')
+                    cache.set(
+                        url, response.text, response.headers.get('ETag'),
+                        response.headers.get('Last-Modified')
+                    )
+                return response.text
+            error = ParserError('Parser GET error %d, %s' % (response.status_code, url))
+            if response.status_code not in RETRY_STATUSES:
+                logger.debug(str(error))
+                raise error
+        if attempt >= settings.PARSER_RETRIES:
+            logger.debug(str(error))
+            raise error
+        delay = get_retry_delay(attempt)
+        logger.debug('%s, retry in %.2fs', error, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_conditional_headers(entry):
+    """
+    @type :entry: CacheEntry | None
+    @rtype: dict
+    """
+    headers = {}
+    if entry is not None and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
 
-    def _get_raw_rows(self, url):
-        items = fromstring(self._get_html_string(url)).xpath(
-            '//div[@class="genTable"]/table[@class="certain-width"]/tr'
+def get_session():
+    """
+    @rtype: requests.Session, one per thread
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=settings.PARSER_POOL_SIZE, pool_maxsize=settings.PARSER_POOL_SIZE
         )
-        return items
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        _local.session = session
+    return session
 
-    @lru_cache()
-    def _get_html_string(self, url):
-        response = requests.get(url)
-        if response.status_code != 200:
-            logger.debug('Parser GET error, %s' % url)
-            raise ParserError('Parser GET error, %s' % url)
-        return response.text
+
+def get_retry_delay(attempt):
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(
+        settings.PARSER_BACKOFF_MAX, settings.PARSER_BACKOFF * 2 ** attempt
+    ))
+
+
+def parse_page(kind, stock_slug, html, first_page=True):
+    """
+    Picklable entry point for parsing in a process pool
+
+    @type :kind: PRICES | INSIDER_TRADES
+    @rtype: (rows, following pages urls, parse seconds)
+    """
+    started = time.time()
+    if kind == PRICES:
+        rows, urls = NasdaqPricesParser(stock_slug).parse_stock_prices(html), []
+    else:
+        parser = NasdaqInsiderTradesParser(stock_slug)
+        if first_page:
+            rows, urls = parser.parse_page(html)
+        else:
+            rows, urls = parser.parse_insider_trades(html), []
+    return rows, urls, time.time() - started
+
+
+def parse_pages(pages):
+    """
+    Picklable entry point for parsing a chunk of pages in a process pool.
+    Rows are packed into tuples without the repeated keys and stock slug,
+    which are smaller to send back than dicts, see unpack_rows.
+
+    @type :pages: list of (kind, stock slug, html, first page)
+    @rtype: list of (packed rows, following pages urls, parse seconds, None | error)
+    """
+    results = []
+    for kind, stock_slug, html, first_page in pages:
+        started = time.time()
+        try:
+            rows, urls, duration = parse_page(kind, stock_slug, html, first_page)
+        except Exception as e:
+            results.append(([], [], time.time() - started, e))
+        else:
+            results.append((pack_rows(kind, rows), urls, duration, None))
+    return results
+
+
+def start_parse_pool(processes):
+    """
+    ProcessPoolExecutor with all its processes forked right away. Call it
+    before starting threads, which may hold a lock (logging, HTTP sessions,
+    caches) at the time of a fork.
+    """
+    pool = ProcessPoolExecutor(processes)
+    # Tasks keep the processes busy, so each one is started in a new process
+    list(pool.map(time.sleep, [0.01] * processes))
+    return pool
+
+
+def pack_rows(kind, rows):
+    """
+    @rtype: list of tuples of ROW_FIELDS[kind] values
+    """
+    return list(map(itemgetter(*ROW_FIELDS[kind]), rows))
+
+
+def unpack_rows(kind, stock_slug, rows):
+    """
+    @rtype: list of dicts, as returned by the Nasdaq parsers
+    """
+    fields = ROW_FIELDS[kind]
+    return [dict(zip(fields, values), stock=stock_slug) for values in rows]
+
+
+def parse_regions(html, regions, required):
+    """
+    Parses only the part of the page from the first to the last region
+    instead of the whole document. A region starts with the tag containing
+    the first occurrence of its marker and ends with the first end tag after
+    the last one. The whole page is parsed if no marker is found or the part
+    has no required elements.
+
+    @type :regions: iterable of (marker, end tag)
+    @type :required: XPath
+    @rtype: lxml element
+    """
+    start = end = None
+    for marker, end_tag in regions:
+        position = html.find(marker)
+        if position < 0:
+            continue
+        region_start = html.rfind('<', 0, position)
+        region_end = html.find(end_tag, html.rfind(marker))
+        if region_start < 0 or region_end < 0:
+            return fromstring(html)
+        region_end += len(end_tag)
+        start = region_start if start is None else min(start, region_start)
+        end = region_end if end is None else max(end, region_end)
+    if start is None:
+        return fromstring(html)
+    tree = fromstring('<div>%s</div>' % html[start:end])
+    return tree if required(tree) else fromstring(html)
+
+
+def _get_page_number(url):
+    match = re.search(r'[?&]page=(\d+)', url)
+    return int(match.group(1)) if match else 1
 
 
 def _normalize_date(value):
     try:
-        return datetime.strptime(value, '%m/%d/%Y').date()
+        return _parse_date(value)
     except ValueError:
         return date.today()
 
 
+@lru_cache(maxsize=4096)
+def _parse_date(value):
+    """
+    mm/dd/yyyy, cached as all tickers have rows of the same days
+    """
+    month, day, year = value.split('/')
+    return date(int(year), int(month), int(day))
+
+
 def _normalize_decimal(value):
     try:
         if value is not None:
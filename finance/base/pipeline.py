@@ -0,0 +1,261 @@
+import os
+import time
+import logging
+
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+
+from django.db import connection
+
+from .parser import (
+    PRICES, INSIDER_TRADES, TaskTiming, NasdaqPricesParser, NasdaqInsiderTradesParser,
+    get_html_string, get_failed_stocks, has_new_trades, parse_pages, unpack_rows,
+    start_parse_pool
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StageStats(object):
+    """
+    @type :name: str
+    @type :items: int, processed pages
+    @type :rows: int
+    @type :busy_time: float, seconds summed over the stage workers
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.busy_time = 0
+        self._lock = Lock()
+
+    def add(self, busy_time, rows=0):
+        with self._lock:
+            self.items += 1
+            self.rows += rows
+            self.busy_time += busy_time
+
+
+class Pipeline(object):
+    """
+    Prices and insider trades import in three overlapping stages:
+    fetch threads -> lxml parsing in a process pool -> one DB writer thread.
+    Stages are connected by bounded queues, so a slow stage holds back the
+    previous one instead of piling up pages in memory.
+
+    @type :stocks: list
+    @type :price_stocks: None | list, stocks to fetch prices for, all by default
+    @type :writers: dict, PRICES | INSIDER_TRADES => (rows: list) => None
+    @type :flush: None | () => None, called by the writer after the last rows
+    @type :fetch_workers: int
+    @type :parse_workers: None | int, processes, cpu count by default
+    @type :parse_chunk_size: int, max fetched pages sent to a parse process at once
+    @type :queue_size: int
+    @type :watermarks: None | dict, stock slug => date of the latest stored
+        insider trade, insider trades pages are fetched one by one until a
+        page has no newer trades
+    """
+    elapsed = None
+    flush_error = None
+
+    def __init__(self, stocks, writers, flush=None, fetch_workers=1, parse_workers=None,
+                 parse_chunk_size=10, queue_size=100, watermarks=None, price_stocks=None):
+        assert isinstance(stocks, list)
+        assert isinstance(price_stocks, list) or price_stocks is None
+        assert isinstance(watermarks, dict) or watermarks is None
+        assert set(writers) == {PRICES, INSIDER_TRADES}
+        assert isinstance(fetch_workers, int) and fetch_workers > 0
+        assert isinstance(parse_chunk_size, int) and parse_chunk_size > 0
+
+        self.stocks = stocks
+        self.price_stocks = stocks if price_stocks is None else price_stocks
+        self.writers = writers
+        self.flush = flush
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.parse_chunk_size = parse_chunk_size
+        self.watermarks = watermarks or {}
+        self.timings = []
+        self.write_errors = {}
+        self.stages = OrderedDict(
+            (name, StageStats(name)) for name in ('fetch', 'parse', 'write')
+        )
+        self.queues = OrderedDict((
+            ('fetch', Queue()),
+            ('parse', Queue(maxsize=queue_size)),
+            ('parse results', Queue(maxsize=self.parse_workers * 2)),
+            ('write', Queue(maxsize=queue_size))
+        ))
+        self.queue_depths = OrderedDict((name, []) for name in self.queues)
+        self._pending = 0
+        self._pending_lock = Lock()
+        self._done = Event()
+        self._finished = Event()
+
+    def run(self):
+        started = time.time()
+        for stock_slug in self.price_stocks:
+            self._add_task(PRICES, stock_slug, NasdaqPricesParser(stock_slug).url)
+        for stock_slug in self.stocks:
+            self._add_task(INSIDER_TRADES, stock_slug, NasdaqInsiderTradesParser(stock_slug).url)
+        if not self._pending:
+            self._done.set()
+
+        workers = [Thread(target=self._fetch) for _ in range(self.fetch_workers)]
+        workers += [Thread(target=self._dispatch), Thread(target=self._collect)]
+        writer = Thread(target=self._write)
+        monitor = Thread(target=self._monitor)
+        # Forked parse processes must not share the caller's DB connection
+        connection.close()
+        with start_parse_pool(self.parse_workers) as executor:
+            self._executor = executor
+            for thread in workers + [writer, monitor]:
+                thread.start()
+            self._done.wait()
+            for _ in range(self.fetch_workers):
+                self.queues['fetch'].put(None)
+            self.queues['parse'].put(None)
+            for thread in workers:
+                thread.join()
+        self.queues['write'].put(None)
+        writer.join()
+        self._finished.set()
+        monitor.join()
+        self.elapsed = time.time() - started
+        if self.flush_error is not None:
+            raise self.flush_error
+        return self
+
+    def get_failed_stocks(self):
+        failed = get_failed_stocks(self.timings)
+        failed.update(self.write_errors)
+        return failed
+
+    def get_queue_depth(self, name):
+        """
+        @rtype: (max, mean) sampled queue size
+        """
+        depths = self.queue_depths[name] or [0]
+        return max(depths), sum(depths) / len(depths)
+
+    def _add_task(self, kind, stock_slug, url, first_page=True, next_urls=()):
+        with self._pending_lock:
+            self._pending += 1
+        self.queues['fetch'].put((kind, stock_slug, url, first_page, next_urls))
+
+    def _task_done(self):
+        with self._pending_lock:
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+
+    def _fetch(self):
+        while True:
+            task = self.queues['fetch'].get()
+            if task is None:
+                break
+            kind, stock_slug, url, first_page, next_urls = task
+            started = time.time()
+            try:
+                html = get_html_string(url)
+            except Exception as e:
+                duration = time.time() - started
+                self.timings.append(TaskTiming(stock_slug, kind, duration, e, duration))
+                logger.exception('Pipeline fetch error, %s', url)
+                self._task_done()
+                continue
+            duration = time.time() - started
+            self.stages['fetch'].add(duration)
+            self.queues['parse'].put((kind, stock_slug, first_page, next_urls, html, duration))
+
+    def _dispatch(self):
+        """
+        Sends the pages waiting in the parse queue to the pool in chunks of
+        up to parse_chunk_size, without waiting for a chunk to fill up
+        """
+        finished = False
+        while not finished:
+            items = [self.queues['parse'].get()]
+            while len(items) < self.parse_chunk_size and items[-1] is not None:
+                try:
+                    items.append(self.queues['parse'].get_nowait())
+                except Empty:
+                    break
+            if items[-1] is None:
+                finished = True
+                items.pop()
+            if items:
+                future = self._executor.submit(parse_pages, [
+                    (kind, stock_slug, html, first_page)
+                    for kind, stock_slug, first_page, next_urls, html, fetch_time in items
+                ])
+                self.queues['parse results'].put((items, future))
+        self.queues['parse results'].put(None)
+
+    def _collect(self):
+        while True:
+            item = self.queues['parse results'].get()
+            if item is None:
+                break
+            items, future = item
+            try:
+                results = future.result()
+            except Exception as e:
+                results = [([], [], 0, e)] * len(items)
+            for page, result in zip(items, results):
+                kind, stock_slug, first_page, next_urls, html, fetch_time = page
+                self._collect_page(kind, stock_slug, next_urls, fetch_time, len(html), *result)
+                self._task_done()
+
+    def _collect_page(self, kind, stock_slug, next_urls, fetch_time, size, rows, urls, duration,
+                      error):
+        if error is not None:
+            self.timings.append(TaskTiming(stock_slug, kind, fetch_time, error, fetch_time, size))
+            logger.error('Pipeline parse error, %s %s: %r', kind, stock_slug, error)
+            return
+        rows = unpack_rows(kind, stock_slug, rows)
+        self.timings.append(TaskTiming(
+            stock_slug, kind, fetch_time + duration, None, fetch_time, size, len(rows)
+        ))
+        self.stages['parse'].add(duration, len(rows))
+        self._add_next_pages(kind, stock_slug, rows, urls or next_urls)
+        self.queues['write'].put((kind, stock_slug, rows))
+
+    def _add_next_pages(self, kind, stock_slug, rows, urls):
+        watermark = self.watermarks.get(stock_slug)
+        if watermark is None:
+            for url in urls:
+                self._add_task(kind, stock_slug, url, first_page=False)
+        elif urls and has_new_trades(rows, watermark):
+            self._add_task(kind, stock_slug, urls[0], first_page=False, next_urls=urls[1:])
+
+    def _write(self):
+        while True:
+            item = self.queues['write'].get()
+            if item is None:
+                break
+            kind, stock_slug, rows = item
+            started = time.time()
+            try:
+                self.writers[kind](rows)
+            except Exception as e:
+                logger.exception('Pipeline write error, %s %s', kind, stock_slug)
+                self.write_errors[stock_slug] = e
+            self.stages['write'].add(time.time() - started, len(rows))
+        if callable(self.flush):
+            started = time.time()
+            try:
+                self.flush()
+            except Exception as e:
+                # Raised by run() in the calling thread
+                self.flush_error = e
+            self.stages['write'].busy_time += time.time() - started
+        connection.close()
+
+    def _monitor(self, interval=0.1):
+        while not self._finished.wait(interval):
+            for name, queue in self.queues.items():
+                self.queue_depths[name].append(queue.qsize())
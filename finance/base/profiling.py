@@ -0,0 +1,231 @@
+import time
+import random
+
+from bisect import bisect_left
+from threading import Lock
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.db import connection
+
+# Seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Queries kept with a slow request sample
+MAX_SAMPLE_QUERIES = 100
+
+
+class Histogram(object):
+    """
+    Counts of values falling into buckets, each bucket is the upper bound
+    of its values, the last count is for values above all buckets
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def get_stats(self):
+        labels = ['<=%s' % bucket for bucket in self.buckets] + ['>%s' % self.buckets[-1]]
+        return OrderedDict((
+            ('count', self.count),
+            ('mean', self.total / self.count if self.count else None),
+            ('max', self.max),
+            ('buckets', OrderedDict(zip(labels, self.counts)))
+        ))
+
+
+class QueryProfiler(object):
+    """
+    Per URL name histograms of request latency, SQL time, SQL queries count
+    and serialization time, and samples of the latest slow requests with
+    their queries
+
+    @type :slow_request: float, seconds
+    @type :max_samples: int
+    """
+
+    def __init__(self, slow_request, max_samples):
+        self.slow_request = slow_request
+        self.samples = deque(maxlen=max_samples)
+        self._views = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, name, profile, queries):
+        """
+        @type :name: str
+        @type :profile: RequestProfile
+        @type :queries: list of debug cursor query dicts with sql and time
+        """
+        sql_time = get_queries_time(queries)
+        with self._lock:
+            histograms = self._views.get(name)
+            if histograms is None:
+                histograms = self._views[name] = OrderedDict((
+                    ('latency', Histogram(TIME_BUCKETS)),
+                    ('sql_time', Histogram(TIME_BUCKETS)),
+                    ('sql_count', Histogram(QUERY_COUNT_BUCKETS)),
+                    ('serialization_time', Histogram(TIME_BUCKETS))
+                ))
+            histograms['latency'].add(profile.latency)
+            histograms['sql_time'].add(sql_time)
+            histograms['sql_count'].add(len(queries))
+            histograms['serialization_time'].add(profile.serialization_time)
+            if profile.latency >= self.slow_request:
+                self.samples.append(OrderedDict((
+                    ('name', name),
+                    ('path', profile.path),
+                    ('status', profile.status),
+                    ('latency', profile.latency),
+                    ('sql_time', sql_time),
+                    ('sql_count', len(queries)),
+                    ('serialization_time', profile.serialization_time),
+                    ('queries', [
+                        {'sql': query['sql'], 'time': float(query['time'])}
+                        for query in queries[:MAX_SAMPLE_QUERIES]
+                    ])
+                )))
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'views': OrderedDict(
+                    (name, OrderedDict(
+                        (key, histogram.get_stats()) for key, histogram in histograms.items()
+                    ))
+                    for name, histograms in sorted(self._views.items())
+                ),
+                'slow_requests': list(self.samples)
+            }
+
+
+class RequestProfile(object):
+    """
+    Measurements of a request being profiled, queries are logged by the
+    debug cursor of the thread's connection from query_index on
+
+    @type :path: str
+    @type :status: None | int
+    @type :latency: None | float, seconds
+    @type :serialization_time: float, seconds without the SQL time
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.status = None
+        self.latency = None
+        self.serialization_time = 0
+        self.started = time.time()
+        self.force_debug_cursor = connection.force_debug_cursor
+        self.query_index = len(connection.queries_log)
+        connection.force_debug_cursor = True
+
+    def finish(self, status):
+        """
+        @rtype: list of queries made since the start
+        """
+        self.latency = time.time() - self.started
+        self.status = status
+        connection.force_debug_cursor = self.force_debug_cursor
+        return list(connection.queries_log)[self.query_index:]
+
+
+class QueryProfileMiddleware(object):
+    """
+    Profiles QUERY_PROFILE_SAMPLE_RATE of requests, their queries are
+    logged with the debug cursor, also when DEBUG is off. Streaming
+    responses are finished when their content is consumed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiler = get_query_profiler()
+        if profiler is None or random.random() >= settings.QUERY_PROFILE_SAMPLE_RATE:
+            return self.get_response(request)
+
+        request.query_profile = RequestProfile(request.get_full_path())
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self._finish(profiler, request, 500)
+            raise
+        if response.streaming:
+            response.streaming_content = self._stream(
+                profiler, request, response.status_code, response.streaming_content
+            )
+        else:
+            self._finish(profiler, request, response.status_code)
+        return response
+
+    def _stream(self, profiler, request, status, content):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            self._finish(profiler, request, status)
+
+    @staticmethod
+    def _finish(profiler, request, status):
+        queries = request.query_profile.finish(status)
+        match = request.resolver_match
+        if match is None:
+            name = 'unresolved'
+        else:
+            name = '%s%s' % ('api:' if match.kwargs.get('api') else '', match.url_name)
+        profiler.add(name, request.query_profile, queries)
+
+
+@contextmanager
+def profile_serialization(request):
+    """
+    Adds the time of the block without its queries to the serialization
+    time of the profiled request
+    """
+    profile = getattr(request, 'query_profile', None)
+    if profile is None:
+        yield
+        return
+    query_index = len(connection.queries_log)
+    started = time.time()
+    try:
+        yield
+    finally:
+        queries = list(connection.queries_log)[query_index:]
+        profile.serialization_time += time.time() - started - get_queries_time(queries)
+
+
+def get_queries_time(queries):
+    return sum(float(query['time']) for query in queries)
+
+
+_profiler = None
+_profiler_lock = Lock()
+
+
+def get_query_profiler():
+    """
+    @rtype: QueryProfiler | None, None if QUERY_PROFILE_SAMPLE_RATE is not set
+    """
+    global _profiler
+    if not settings.QUERY_PROFILE_SAMPLE_RATE:
+        return None
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = QueryProfiler(
+                settings.QUERY_PROFILE_SLOW_REQUEST, settings.QUERY_PROFILE_SLOW_SAMPLES
+            )
+    return _profiler
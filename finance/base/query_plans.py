@@ -0,0 +1,126 @@
+import re
+
+from collections import namedtuple
+
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from .models import Stock, Insider, delta_cache
+
+# Plan nodes that mean a missing or unusable index, Sort stands for every
+# sort node type (Sort, Incremental Sort on PostgreSQL >= 13)
+CHECKED_NODES = ('Seq Scan', 'Sort')
+
+# Server-side cursors of QuerySet.iterator()
+DECLARE_CURSOR = re.compile(r'^\s*DECLARE\s.*?\sCURSOR\s.*?\bFOR\s+', re.IGNORECASE | re.DOTALL)
+
+# url name, by stock, query, nodes allowed for the endpoint. The next page
+# of cursor paginated responses is checked too.
+CASES = (
+    # Lists all stocks
+    ('stock-list', False, {}, ('Seq Scan',)),
+    ('stock-detail', True, {'page_size': 10}, ()),
+    ('insiders-trades', True, {'page_size': 10}, ()),
+    ('insider-trade', True, {'page_size': 10}, ()),
+    # Only the found periods are sorted
+    ('delta-list', True, {'type_': 'close', 'max_delta': 5}, ('Sort',)),
+    ('delta-batch', True, {'type_': 'close', 'max_deltas': '1,5,10'}, ('Sort',)),
+    ('analytics', True, {'date_from': '2000-01-01', 'date_to': '2100-01-01'}, ()),
+    # Ranks all stocks by a computed value
+    ('market-analytics', False, {'date_from': '2000-01-01', 'date_to': '2100-01-01'}, ('Sort',)),
+    ('stock-batch', False, {'trades': 1}, ()),
+)
+
+QueryPlan = namedtuple('QueryPlan', ('name', 'query', 'sql', 'nodes', 'found'))
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def check_query_plans(stock):
+    """
+    EXPLAIN of the queries of every case with seq scans and sorts (also
+    incremental ones) disabled for the planner, so they only appear when no
+    index can be used, whatever the amount of data
+
+    @type :stock: Stock, a stock with prices
+    @rtype: Iterator of QueryPlan, found are the checked nodes not allowed
+        for the endpoint
+    """
+    insider = Insider.objects.filter(stock=stock).order_by('id').first()
+    client = Client()
+    for name, by_stock, query, allowed in CASES:
+        kwargs = {'api': True}
+        if by_stock:
+            kwargs['slug'] = stock.slug
+        if name == 'insider-trade':
+            if insider is None:
+                continue
+            kwargs['insider_id'] = insider.id
+        if name == 'stock-batch':
+            # A single stock would hide the order of the rows of several
+            query = dict(query, tickers=','.join(
+                Stock.objects.filter(id__gte=stock.id).order_by('id')[:3].values_list(
+                    'slug', flat=True
+                )
+            ))
+        url = reverse(name, kwargs=kwargs)
+        for sql in _get_queries(client, url, query):
+            nodes = _explain(sql)
+            found = sorted(set(
+                n for n, _ in nodes
+                if _get_checked_node(n) in CHECKED_NODES and _get_checked_node(n) not in allowed
+            ))
+            yield QueryPlan(name, query, sql, nodes, found)
+
+
+def _get_queries(client, url, query):
+    """
+    SELECT queries of a request, also of server-side cursors, made with
+    the API cache, the price store and the delta memo off
+    """
+    delta_cache.clear()
+    with override_settings(ALLOWED_HOSTS=['testserver'], API_CACHE=None,
+                           PRICE_STORE_MAX_SIZE=None):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url, query)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elif response.status_code == 200:
+                data = response.json()
+                if isinstance(data, dict) and data.get('next'):
+                    response = client.get(data['next'])
+    if response.status_code != 200:
+        raise QueryPlanError('%s returned %d' % (url, response.status_code))
+    queries = [DECLARE_CURSOR.sub('', q['sql']) for q in context.captured_queries]
+    return [sql for sql in queries if sql.lstrip().upper().startswith(('SELECT', 'WITH'))]
+
+
+def _explain(sql):
+    """
+    @rtype: list of (node type, relation name)
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('SET LOCAL enable_sort = off')
+        if connection.pg_version >= 130000:
+            cursor.execute('SET LOCAL enable_incremental_sort = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql.replace('%', '%%'))
+        plan = cursor.fetchone()[0]
+        # SET LOCAL outlives a released savepoint, the planner settings must
+        # not leak into the queries of an enclosing transaction (tests)
+        transaction.set_rollback(True)
+    nodes = []
+    stack = [plan[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append((node['Node Type'], node.get('Relation Name')))
+        stack.extend(node.get('Plans', ()))
+    return nodes
+
+
+def _get_checked_node(node_type):
+    return 'Sort' if node_type.endswith('Sort') else node_type
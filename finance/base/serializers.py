@@ -1,5 +1,13 @@
 from rest_framework import serializers
-from .models import Stock, StockPrice, InsiderTrade, Insider
+from .models import Stock, StockPrice, InsiderTrade, Insider, PERIOD_CHANGE_COLUMNS
+
+
+def _format_decimal(value):
+    return None if value is None else format(value, 'f')
+
+
+def _format_date(value):
+    return value.isoformat()
 
 
 class StockSerializer(serializers.ModelSerializer):
@@ -17,6 +25,11 @@ class StockPriceSerializer(serializers.ModelSerializer):
 
 
 class StockPriceWithDeltaSerializer(StockPriceSerializer):
+    open_delta = serializers.DecimalField(max_digits=10, decimal_places=4, read_only=True)
+    high_delta = serializers.DecimalField(max_digits=10, decimal_places=4, read_only=True)
+    low_delta = serializers.DecimalField(max_digits=10, decimal_places=4, read_only=True)
+    close_delta = serializers.DecimalField(max_digits=10, decimal_places=4, read_only=True)
+
     class Meta(StockPriceSerializer.Meta):
         fields = StockPriceSerializer.Meta.fields + (
             'open_delta', 'high_delta', 'low_delta', 'close_delta'
@@ -40,7 +53,102 @@ class InsiderTradeSerializer(serializers.ModelSerializer):
         )
 
 
-class StockDeltaSerializer(serializers.Serializer):
-    date_from = serializers.DateField()
-    date_to = serializers.DateField()
-    delta = serializers.DecimalField(max_digits=10, decimal_places=4)
+class RowSerializer(object):
+    """
+    Serializes rows of .values_list(*columns) without the DRF fields
+    machinery, called as a DRF serializer: Serializer(rows, many=True).data
+    """
+    columns = ()
+
+    def __init__(self, rows, many=True):
+        assert many
+
+        self.rows = rows
+
+    @property
+    def data(self):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in self.rows]
+
+    @classmethod
+    def get_rows(cls, queryset):
+        return queryset.values_list(*cls.columns)
+
+    @classmethod
+    def get_key(cls, fields):
+        """
+        @rtype: (row) => tuple of fields values
+        """
+        indexes = [cls.columns.index(name) for name in fields]
+        return lambda row: tuple(row[i] for i in indexes)
+
+    def to_representation(self, row):
+        raise NotImplementedError
+
+
+class StockPriceRowSerializer(RowSerializer):
+    """
+    StockPriceSerializer without the stock, it is the same for all rows
+    """
+    columns = ('id', 'date', 'open', 'high', 'low', 'close', 'volume')
+
+    def to_representation(self, row):
+        id_, date, open_, high, low, close, volume = row
+        return {
+            'date': _format_date(date),
+            'open': _format_decimal(open_),
+            'high': _format_decimal(high),
+            'low': _format_decimal(low),
+            'close': _format_decimal(close),
+            'volume': volume
+        }
+
+
+class InsiderTradeRowSerializer(RowSerializer):
+    columns = (
+        'id', 'date', 'insider_id', 'insider__name', 'relation', 'transaction_type',
+        'owner_type', 'shares_traded', 'last_price', 'shares_held'
+    )
+
+    def to_representation(self, row):
+        (id_, date, insider_id, insider_name, relation, transaction_type, owner_type,
+         shares_traded, last_price, shares_held) = row
+        return {
+            'date': _format_date(date),
+            'insider': {'id': insider_id, 'name': insider_name},
+            'relation': relation,
+            'transaction_type': transaction_type,
+            'owner_type': owner_type,
+            'shares_traded': shares_traded,
+            'last_price': _format_decimal(last_price),
+            'shares_held': shares_held
+        }
+
+
+class StockDeltaRowSerializer(RowSerializer):
+    """
+    Rows are StockPrice.objects.delta() dicts
+    """
+
+    def to_representation(self, row):
+        return {
+            'date_from': _format_date(row['date_from']),
+            'date_to': _format_date(row['date_to']),
+            'delta': _format_decimal(row['delta'])
+        }
+
+
+class PeriodChangeRowSerializer(RowSerializer):
+    """
+    Rows are StockPrice.objects.period_changes() dicts
+    """
+
+    def to_representation(self, row):
+        data = {
+            'slug': row['slug'],
+            'date_from': _format_date(row['date_from']),
+            'date_to': _format_date(row['date_to'])
+        }
+        for column in PERIOD_CHANGE_COLUMNS:
+            data[column] = _format_decimal(row[column])
+        return data
@@ -0,0 +1,219 @@
+import logging
+
+from datetime import date
+from decimal import Decimal
+from threading import Lock
+from collections import OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+
+from .models import StockPrice, STOCK_PRICE_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Prices are kept as integers of 1 / SCALE, the precision of StockPrice fields
+SCALE = 10 ** 4
+
+NULL = np.iinfo(np.int64).min
+
+
+def _to_int(value):
+    return NULL if value is None else int(value * SCALE)
+
+
+def _to_decimal(value):
+    return None if value == NULL else Decimal(int(value)).scaleb(-4)
+
+
+class PriceSeries(object):
+    """
+    Price history of a stock as numpy columns ordered by date
+
+    @type :stock_id: int
+    @type :version: int, Stock.version the series was loaded at
+    @type :days: numpy int32 array, date ordinals
+    @type :prices: dict, price type => numpy int64 array scaled by SCALE, NULL for missing
+    @type :volume: numpy int64 array, -1 for missing
+    """
+
+    def __init__(self, stock_id, version, days, prices, volume):
+        self.stock_id = stock_id
+        self.version = version
+        self.days = days
+        self.prices = prices
+        self.volume = volume
+
+    @classmethod
+    def load(cls, stock):
+        rows = list(
+            StockPrice.objects.filter(stock=stock).order_by('date')
+            .values_list('date', *(STOCK_PRICE_TYPES + ('volume',)))
+        )
+        count = len(rows)
+        columns = list(zip(*rows)) or [()] * (len(STOCK_PRICE_TYPES) + 2)
+        return cls(
+            stock.id,
+            stock.version,
+            np.fromiter((d.toordinal() for d in columns[0]), np.int32, count),
+            dict(
+                (type_, np.fromiter((_to_int(v) for v in values), np.int64, count))
+                for type_, values in zip(STOCK_PRICE_TYPES, columns[1:-1])
+            ),
+            np.fromiter((-1 if v is None else v for v in columns[-1]), np.int64, count)
+        )
+
+    @property
+    def nbytes(self):
+        return (
+            self.days.nbytes + self.volume.nbytes +
+            sum(values.nbytes for values in self.prices.values())
+        )
+
+    def analytics(self, stock, date_from, date_to):
+        """
+        Same as StockPrice.objects.analytics()
+
+        @rtype: list of StockPrice
+        """
+        start = np.searchsorted(self.days, date_from.toordinal(), 'left')
+        end = np.searchsorted(self.days, date_to.toordinal(), 'right')
+        if start >= end:
+            return []
+        seed = max(start - 1, 0)
+        deltas = {}
+        for type_, values in self.prices.items():
+            window = values[seed:end]
+            delta = np.empty(len(window), np.int64)
+            delta[0] = NULL
+            delta[1:] = window[1:] - window[:-1]
+            delta[1:][(window[1:] == NULL) | (window[:-1] == NULL)] = NULL
+            deltas[type_] = delta[start - seed:]
+
+        prices = []
+        for i in range(start, end):
+            price = StockPrice(
+                date=date.fromordinal(int(self.days[i])), stock=stock,
+                volume=None if self.volume[i] < 0 else int(self.volume[i]),
+                **dict((type_, _to_decimal(values[i])) for type_, values in self.prices.items())
+            )
+            for type_ in STOCK_PRICE_TYPES:
+                setattr(price, '%s_delta' % type_, _to_decimal(deltas[type_][i - start]))
+            prices.append(price)
+        return prices
+
+    def deltas(self, max_deltas, type_):
+        """
+        Same as StockPrice.objects.delta() for every threshold
+
+        @rtype: dict, max_delta => list of dicts with date_from, date_to and delta
+        """
+        values = self.prices[type_]
+        present = values != NULL
+        days, values = self.days[present], values[present]
+        return dict(
+            (max_delta, self._find_periods(days, values, max_delta * SCALE))
+            for max_delta in max_deltas
+        )
+
+    @staticmethod
+    def _find_periods(days, values, threshold, window=16):
+        """
+        Each period end is searched in doubling windows from the period start,
+        so the whole series is scanned about once
+        """
+        result = []
+        count = len(values)
+        start = 0
+        while start < count - 1:
+            position = start + 1
+            size = window
+            end = None
+            while position < count:
+                found = np.flatnonzero(
+                    np.abs(values[position:position + size] - values[start]) > threshold
+                )
+                if found.size:
+                    end = position + int(found[0])
+                    break
+                position += size
+                size *= 2
+            if end is None:
+                break
+            result.append({
+                'date_from': date.fromordinal(int(days[start])),
+                'date_to': date.fromordinal(int(days[end])),
+                'delta': _to_decimal(values[end] - values[start])
+            })
+            start = end
+        return result
+
+
+class PriceStore(object):
+    """
+    In-process PriceSeries of recently used stocks. A series is loaded on
+    first use and reloaded when the stock version changes, the least
+    recently used series are dropped when the total size exceeds max_size.
+
+    @type :max_size: int, bytes
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._series = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, stock):
+        """
+        @rtype: PriceSeries
+        """
+        with self._lock:
+            series = self._series.get(stock.id)
+            if series is not None and series.version == stock.version:
+                self._series.move_to_end(stock.id)
+                return series
+        series = PriceSeries.load(stock)
+        with self._lock:
+            old = self._series.pop(stock.id, None)
+            if old is not None:
+                self.size -= old.nbytes
+            self._series[stock.id] = series
+            self.size += series.nbytes
+            while self.size > self.max_size and len(self._series) > 1:
+                _, evicted = self._series.popitem(last=False)
+                self.size -= evicted.nbytes
+        if series.nbytes > self.max_size:
+            logger.warning(
+                'Price series of stock %d (%d bytes) exceeds PRICE_STORE_MAX_SIZE',
+                stock.id, series.nbytes
+            )
+        return series
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'stocks': OrderedDict(
+                    (stock_id, series.nbytes) for stock_id, series in self._series.items()
+                )
+            }
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_price_store():
+    """
+    @rtype: PriceStore | None, None if PRICE_STORE_MAX_SIZE is not set
+    """
+    global _store
+    if not settings.PRICE_STORE_MAX_SIZE:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = PriceStore(settings.PRICE_STORE_MAX_SIZE)
+    return _store
@@ -0,0 +1,86 @@
+import random
+
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.test import TestCase
+
+from finance.base.benchmark import generate_data
+from finance.base.models import Stock, StockPrice, STOCK_PRICE_TYPES, delta_cache
+from finance.base.query_plans import CASES, check_query_plans
+from finance.base.store import PriceSeries
+
+
+class DeltaTestCase(TestCase):
+    """
+    SQL StockPrice.objects.delta, the one pass StockPrice.objects.deltas and
+    the numpy PriceSeries.deltas against the python_delta reference on random
+    price series, generated with a fixed seed
+    """
+    seed = 0
+    series_number = 5
+    length = 250
+    thresholds = [0, 1, 2, 5, 10, 20]
+
+    @classmethod
+    def setUpTestData(cls):
+        rand = random.Random(cls.seed)
+        cls.stocks = [cls._create_random_stock(rand, i) for i in range(cls.series_number)]
+
+    @classmethod
+    def _create_random_stock(cls, rand, number):
+        stock = Stock.objects.create(slug='delta-%d' % number)
+        value = Decimal(rand.randint(1000, 20000)) / 100
+        day = date(2017, 1, 1)
+        prices = []
+        for i in range(cls.length):
+            value = max(Decimal('0.01'), value + Decimal(rand.randint(-500, 500)) / 100)
+            prices.append(StockPrice(
+                stock=stock, date=day + timedelta(days=i), volume=rand.randint(0, 10 ** 6),
+                **dict(
+                    (type_, None if rand.random() < 0.05 else value)
+                    for type_ in STOCK_PRICE_TYPES
+                )
+            ))
+        StockPrice.objects.bulk_create(prices)
+        return stock
+
+    def setUp(self):
+        delta_cache.clear()
+
+    def test_deltas_match_python_delta(self):
+        for stock in self.stocks:
+            series = PriceSeries.load(stock)
+            for type_ in STOCK_PRICE_TYPES:
+                batch = StockPrice.objects.deltas(stock, self.thresholds, type_)
+                vectorized = series.deltas(self.thresholds, type_)
+                for max_delta in self.thresholds:
+                    expected = StockPrice.objects.python_delta(stock, max_delta, type_)
+                    with self.subTest(stock=stock.slug, type_=type_, max_delta=max_delta):
+                        self.assertTrue(expected)
+                        self.assertEqual(
+                            StockPrice.objects.delta(stock, max_delta, type_), expected
+                        )
+                        self.assertEqual(batch[max_delta], expected)
+                        self.assertEqual(vectorized[max_delta], expected)
+
+
+class QueryPlansTestCase(TestCase):
+    """
+    Queries of every API endpoint use indexes, EXPLAIN on generated stocks
+    with prices and insider trades
+    """
+    tickers = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        slugs = generate_data(cls.tickers, days=60, insiders=3, trades=30, prefix='plans')
+        cls.stock = Stock.objects.get(slug=slugs[0])
+
+    def test_no_seq_scans_and_sorts(self):
+        names = set()
+        for plan in check_query_plans(self.stock):
+            names.add(plan.name)
+            with self.subTest(name=plan.name, sql=plan.sql):
+                self.assertEqual(plan.found, [], plan.nodes)
+        self.assertEqual(names, set(name for name, _, _, _ in CASES))
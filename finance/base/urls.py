@@ -1,14 +1,20 @@
 from django.conf.urls import url
 from .views import (
     StockListView, StockDetailView, InsiderTradeListView, StockDeltaView,
-    StockAnalyticsView
+    StockAnalyticsView, StockDeltaBatchView, MarketAnalyticsView, StockBatchView,
+    CacheStatsView, QueryProfileView
 )
 
 urlpatterns = [
     url(r'^$', StockListView.as_view(), name='stock-list'),
+    url(r'^internal/cache/$', CacheStatsView.as_view(), name='cache-stats'),
+    url(r'^internal/profile/$', QueryProfileView.as_view(), name='query-profile'),
+    url(r'^analytics/$', MarketAnalyticsView.as_view(), name='market-analytics'),
+    url(r'^batch/$', StockBatchView.as_view(), name='stock-batch'),
     url(r'^(?P<slug>[\w.-]+)/$', StockDetailView.as_view(), name='stock-detail'),
     url(r'^(?P<slug>[\w.-]+)/insider/$', InsiderTradeListView.as_view(), name='insiders-trades'),
     url(r'^(?P<slug>[\w.-]+)/insider/(?P<insider_id>\d+)/$', InsiderTradeListView.as_view(), name='insider-trade'),
     url(r'^(?P<slug>[\w.-]+)/delta/$', StockDeltaView.as_view(), name='delta-list'),
+    url(r'^(?P<slug>[\w.-]+)/delta/batch/$', StockDeltaBatchView.as_view(), name='delta-batch'),
     url(r'^(?P<slug>[\w.-]+)/analytics/$', StockAnalyticsView.as_view(), name='analytics')
 ]
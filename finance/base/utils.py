@@ -1,5 +1,85 @@
-def split_list(list_, number):
-    length = len(list_)
-    if number > length:
-        number = length
-    return [list_[i * length // number:(i + 1) * length // number] for i in range(number)]
+from threading import Lock
+from datetime import date, timedelta
+from collections import OrderedDict
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile, None for an empty sequence
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[int(index)]
+
+
+def get_percentiles(values):
+    """
+    @rtype: OrderedDict with p50, p95, p99, max and total, None for no values
+    """
+    return OrderedDict((
+        ('p50', percentile(values, 50)),
+        ('p95', percentile(values, 95)),
+        ('p99', percentile(values, 99)),
+        ('max', max(values) if values else None),
+        ('total', sum(values))
+    ))
+
+
+def get_last_trading_day(today=None):
+    """
+    The last weekday before today, exchange holidays are not taken into account
+    """
+    day = (today or date.today()) - timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process mapping which keeps max_size recently used items
+
+    @type :max_size: int
+    """
+
+    def __init__(self, max_size):
+        assert isinstance(max_size, int) and max_size > 0
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
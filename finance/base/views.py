@@ -1,15 +1,30 @@
+from operator import itemgetter
+from itertools import islice, groupby
+
 from rest_framework.utils.urls import remove_query_param, replace_query_param
 
+from django.conf import settings
+from django.db.models import QuerySet
 from django.http import Http404
-from django.http.response import JsonResponse
-from django.views.generic import ListView, TemplateView
-
-from .models import Stock, StockPrice, Insider, InsiderTrade
+from django.core.exceptions import PermissionDenied
+from django.http.response import JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.views.generic import View, ListView, TemplateView
+
+from .db import estimate_count
+from .store import get_price_store
+from .api_cache import get_api_cache
+from .profiling import get_query_profiler, profile_serialization
+from .models import Stock, StockPrice, Insider, InsiderTrade, delta_cache
+from .pagination import KeysetPaginator, InvalidCursor
 from .serializers import (
-    StockSerializer, StockPriceSerializer, InsiderTradeSerializer,
-    StockDeltaSerializer, StockPriceWithDeltaSerializer
+    RowSerializer, StockSerializer, StockPriceRowSerializer, InsiderTradeRowSerializer,
+    StockDeltaRowSerializer, StockPriceWithDeltaSerializer, PeriodChangeRowSerializer
+)
+from .forms import (
+    StockPriceDeltaForm, StockPriceDeltaBatchForm, StockPriceAnalyticsForm, MarketAnalyticsForm,
+    StockBatchForm
 )
-from .forms import StockPriceDeltaForm, StockPriceAnalyticsForm
 
 
 class StockMixin(object):
@@ -25,6 +40,10 @@ class StockMixin(object):
     def get_stock(self, slug):
         return Stock.objects.get(slug=slug)
 
+    def get_cache_key(self):
+        api_cache = get_api_cache()
+        return api_cache.get_key(self.stock, self.request) if api_cache else None
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['stock'] = self.stock
@@ -32,24 +51,145 @@ class StockMixin(object):
 
 
 class JsonResponseMixin(object):
+    """
+    ?stream=json or ?stream=ndjson exports all rows, serialized and sent
+    by chunks of stream_chunk_size
+
+    @type :cursor_fields: None | tuple, keyset pagination of the API by these
+        fields in descending order, unique together within the queryset
+    """
     serializer = None
+    cursor_fields = None
+    page_size = 100
+    max_page_size = 1000
+    stream_chunk_size = 1000
+
+    STREAM_CONTENT_TYPES = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson'
+    }
 
     def get(self, request, **kwargs):
         if kwargs.get('api'):
-            return JsonResponse(self._get_json_context_data(), safe=False)
+            stream = request.GET.get('stream')
+            if stream in self.STREAM_CONTENT_TYPES:
+                return StreamingHttpResponse(
+                    self._stream(stream), content_type=self.STREAM_CONTENT_TYPES[stream]
+                )
+            return self._get_json_response(self._get_cached_json_context_data())
         return super().get(request, **kwargs)
 
-    def _get_json_context_data(self):
+    def get_cache_key(self):
+        """
+        @rtype: None | str, API responses with a key are cached
+        """
+        return None
+
+    def get_api_queryset(self):
+        """
+        Rows for the serializer, RowSerializer subclasses get values_list rows
+        """
         queryset = self.get_queryset()
+        if isinstance(queryset, QuerySet) and issubclass(self.serializer, RowSerializer):
+            return self.serializer.get_rows(queryset)
+        return queryset
+
+    def get_envelope(self):
+        """
+        Data common for all rows, added to paginated and streamed JSON responses
+        """
+        return {}
+
+    def _stream(self, format_):
+        encoder = DjangoJSONEncoder()
+        envelope = self.get_envelope()
+        if format_ == 'json':
+            yield '{%s"results": [' % ''.join(
+                '%s: %s, ' % (encoder.encode(key), encoder.encode(value))
+                for key, value in envelope.items()
+            ) if envelope else '['
+        first = True
+        for chunk in self._iter_chunks():
+            with profile_serialization(self.request):
+                items = [encoder.encode(item) for item in self.serializer(chunk, many=True).data]
+            if format_ == 'ndjson':
+                yield ''.join('%s\n' % item for item in items)
+            elif items:
+                yield ('' if first else ',') + ','.join(items)
+                first = False
+        if format_ == 'json':
+            yield ']}' if envelope else ']'
+
+    def _iter_chunks(self):
+        """
+        Keyset pages for cursor paginated views, so a chunk is an index range
+        scan and no cursor is held open between chunks
+        """
+        queryset = self.get_api_queryset()
+        if self.cursor_fields:
+            return self._get_paginator(queryset, self.stream_chunk_size).iterate()
+        iterator = queryset.iterator() if isinstance(queryset, QuerySet) else iter(queryset)
+        return iter(lambda: list(islice(iterator, self.stream_chunk_size)), [])
+
+    def _get_cached_json_context_data(self):
+        key = self.get_cache_key()
+        if key is None:
+            return self._get_json_context_data()
+        return get_api_cache().get_or_set(key, self._get_json_context_data)
+
+    def _get_json_context_data(self):
+        queryset = self.get_api_queryset()
+        if self.cursor_fields:
+            return self._get_cursor_page_data(queryset)
         if getattr(self, 'paginate_by', None):
             paginator, page, queryset, is_paginated = self.paginate_queryset(queryset, self.paginate_by)
             return {
                 'count': page.paginator.count,
                 'next': self._get_next_link(page),
                 'previous': self._get_previous_link(page),
-                'results': self.serializer(queryset, many=True).data
+                'results': self._serialize(queryset)
             }
-        return self.serializer(queryset, many=True).data
+        return self._serialize(queryset)
+
+    def _get_cursor_page_data(self, queryset):
+        paginator = self._get_paginator(queryset, self._get_page_size())
+        try:
+            page = paginator.get_page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        url = self.request.build_absolute_uri()
+        data = self.get_envelope()
+        data.update({
+            'count': estimate_count(queryset) if self.request.GET.get('count') else None,
+            'next': page.next_cursor and replace_query_param(url, 'cursor', page.next_cursor),
+            'previous': (
+                page.previous_cursor and
+                replace_query_param(url, 'cursor', page.previous_cursor)
+            ),
+            'results': self._serialize(page.object_list)
+        })
+        return data
+
+    def _serialize(self, rows):
+        with profile_serialization(self.request):
+            return self.serializer(rows, many=True).data
+
+    def _get_json_response(self, data):
+        with profile_serialization(self.request):
+            return JsonResponse(data, safe=False)
+
+    def _get_paginator(self, queryset, page_size):
+        key = None
+        if issubclass(self.serializer, RowSerializer):
+            key = self.serializer.get_key(self.cursor_fields)
+        return KeysetPaginator(queryset, self.cursor_fields, page_size, key=key)
+
+    def _get_page_size(self):
+        try:
+            page_size = int(self.request.GET['page_size'])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
 
     def _get_next_link(self, page):
         if not page.has_next():
@@ -68,6 +208,38 @@ class JsonResponseMixin(object):
         return replace_query_param(url, 'page', page_number)
 
 
+class InternalMixin(object):
+    """
+    Allows requests of staff users and from INTERNAL_IPS only
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not (request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+            raise PermissionDenied
+        return super().dispatch(request, *args, **kwargs)
+
+
+class QueryProfileView(InternalMixin, View):
+    """
+    Histograms and slow requests collected by QueryProfileMiddleware
+    """
+
+    def get(self, request, **kwargs):
+        profiler = get_query_profiler()
+        return JsonResponse(profiler.get_stats() if profiler else None, safe=False)
+
+
+class CacheStatsView(InternalMixin, View):
+    def get(self, request, **kwargs):
+        api_cache = get_api_cache()
+        store = get_price_store()
+        return JsonResponse({
+            'api': api_cache.get_stats() if api_cache else None,
+            'delta': delta_cache.get_stats(),
+            'store': store.get_stats() if store else None
+        })
+
+
 class StockListView(JsonResponseMixin, ListView):
     model = Stock
     template_name = 'base/stock_list.html'
@@ -77,16 +249,22 @@ class StockListView(JsonResponseMixin, ListView):
 class StockDetailView(StockMixin, JsonResponseMixin, ListView):
     model = StockPrice
     template_name = 'base/stock_detail.html'
-    serializer = StockPriceSerializer
+    serializer = StockPriceRowSerializer
+    # Prices are unique by date within a stock
+    cursor_fields = ('date',)
 
     def get_queryset(self):
         return super().get_queryset().filter(stock=self.stock)
 
+    def get_envelope(self):
+        return {'stock': StockSerializer(self.stock).data}
+
 
 class InsiderTradeListView(StockMixin, JsonResponseMixin, ListView):
     model = InsiderTrade
     template_name = 'base/trade_list.html'
-    serializer = InsiderTradeSerializer
+    serializer = InsiderTradeRowSerializer
+    cursor_fields = ('date', 'id')
     insider = None
     paginate_by = 100
 
@@ -104,7 +282,7 @@ class InsiderTradeListView(StockMixin, JsonResponseMixin, ListView):
 
     def get_queryset(self):
         queryset = super().get_queryset().filter(
-            insider__stock=self.stock
+            stock=self.stock
         ).select_related('insider')
         if self.insider:
             queryset = queryset.filter(insider=self.insider)
@@ -118,13 +296,20 @@ class InsiderTradeListView(StockMixin, JsonResponseMixin, ListView):
 
 class StockAnalyticsView(StockDetailView):
     serializer = StockPriceWithDeltaSerializer
+    cursor_fields = None
+    context_object_name = 'stockprice_list'
+
+    def get_envelope(self):
+        return {}
 
     def get_queryset(self):
         form = self.get_form()
-        queryset = super().get_queryset()
-        if form.is_valid():
-            return queryset.in_period(**form.cleaned_data).with_previous()
-        return queryset.none()
+        if not form.is_valid():
+            return StockPrice.objects.none()
+        store = get_price_store()
+        if store is not None:
+            return store.get(self.stock).analytics(self.stock, **form.cleaned_data)
+        return StockPrice.objects.analytics(stock=self.stock, **form.cleaned_data)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -137,13 +322,16 @@ class StockAnalyticsView(StockDetailView):
 
 class StockDeltaView(StockMixin, JsonResponseMixin, TemplateView):
     template_name = 'base/delta_list.html'
-    serializer = StockDeltaSerializer
+    serializer = StockDeltaRowSerializer
 
     def get_queryset(self):
         form = self.get_form()
         if form.is_valid():
-            return StockPrice.objects.delta(stock=self.stock, **form.cleaned_data)
-        return StockPrice.objects.none()
+            max_delta = form.cleaned_data['max_delta']
+            return StockPrice.objects.deltas(
+                self.stock, [max_delta], form.cleaned_data['type_'], store=get_price_store()
+            )[max_delta]
+        return []
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -153,3 +341,123 @@ class StockDeltaView(StockMixin, JsonResponseMixin, TemplateView):
 
     def get_form(self):
         return StockPriceDeltaForm(self.request.GET)
+
+
+class StockDeltaBatchView(StockMixin, JsonResponseMixin, View):
+    """
+    Delta periods for several thresholds:
+    ?type_=close&max_deltas=1,5,10 => [{"max_delta": 1, "results": [...]}, ...]
+    """
+    serializer = StockDeltaRowSerializer
+
+    def get(self, request, **kwargs):
+        return self._get_json_response(self._get_cached_json_context_data())
+
+    def _get_json_context_data(self):
+        form = self.get_form()
+        if not form.is_valid():
+            return []
+        deltas = StockPrice.objects.deltas(
+            self.stock, store=get_price_store(), **form.cleaned_data
+        )
+        return [
+            {'max_delta': max_delta, 'results': self._serialize(deltas[max_delta])}
+            for max_delta in form.cleaned_data['max_deltas']
+        ]
+
+    def get_form(self):
+        return StockPriceDeltaBatchForm(self.request.GET)
+
+
+class MarketAnalyticsView(JsonResponseMixin, TemplateView):
+    """
+    Prices change of all or selected stocks over a period, ranked
+    """
+    template_name = 'base/market_analytics.html'
+    serializer = PeriodChangeRowSerializer
+
+    def get_queryset(self):
+        form = self.get_form()
+        if not form.is_valid():
+            return []
+        params = dict(form.cleaned_data)
+        slugs = params.pop('tickers')
+        return StockPrice.objects.period_changes(slugs=slugs, **params)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['form'] = self.get_form()
+        context['change_list'] = self.get_queryset()
+        return context
+
+    def get_form(self):
+        return MarketAnalyticsForm(self.request.GET)
+
+
+class StockBatchView(View):
+    """
+    Prices, and insider trades with ?trades=1, of several stocks streamed
+    stock by stock: ?tickers=aapl,cvx&date_from=..&date_to=.. =>
+    [{"slug": "aapl", "prices": [...], "insider_trades": [...]}, ...],
+    ?stream=ndjson puts every stock on a line. Each kind of rows is read
+    by one query for all the stocks, ordered by stock, so stocks come in
+    descending id order of the index scans, not in the order of ?tickers.
+    """
+
+    def get(self, request, **kwargs):
+        form = StockBatchForm(request.GET)
+        ndjson = request.GET.get('stream') == 'ndjson'
+        return StreamingHttpResponse(
+            self._stream(form, ndjson),
+            content_type=JsonResponseMixin.STREAM_CONTENT_TYPES['ndjson' if ndjson else 'json']
+        )
+
+    def _stream(self, form, ndjson):
+        if not ndjson:
+            yield '['
+        if form.is_valid():
+            encoder = DjangoJSONEncoder()
+            for i, item in enumerate(self._iter_stocks(**form.cleaned_data)):
+                with profile_serialization(self.request):
+                    data = encoder.encode(item)
+                yield '%s\n' % data if ndjson else (',' if i else '') + data
+        if not ndjson:
+            yield ']'
+
+    def _iter_stocks(self, tickers, date_from=None, date_to=None, trades=False):
+        stocks = list(
+            Stock.objects.filter(slug__in=tickers).order_by('-id').values_list('id', 'slug')
+        )
+        ids = [id_ for id_, _ in stocks]
+        # Descending orders of the (stock, date) and (stock, date, id) indexes,
+        # a backward index scan returns the rows of all stocks without a sort
+        kinds = [(
+            'prices', StockPriceRowSerializer, StockPrice.objects.order_by('-stock_id', '-date')
+        )]
+        if trades:
+            kinds.append((
+                'insider_trades', InsiderTradeRowSerializer,
+                InsiderTrade.objects.order_by('-stock_id', '-date', '-id')
+            ))
+
+        groups = []
+        for name, serializer, queryset in kinds:
+            queryset = queryset.filter(stock_id__in=ids)
+            if date_from:
+                queryset = queryset.filter(date__gte=date_from)
+            if date_to:
+                queryset = queryset.filter(date__lte=date_to)
+            rows = queryset.values_list('stock_id', *serializer.columns)
+            groups.append((name, serializer, groupby(rows.iterator(), itemgetter(0))))
+
+        heads = [next(iterator, None) for _, _, iterator in groups]
+        for stock_id, slug in stocks:
+            item = {'slug': slug}
+            for i, (name, serializer, iterator) in enumerate(groups):
+                rows = []
+                if heads[i] is not None and heads[i][0] == stock_id:
+                    rows = [row[1:] for row in heads[i][1]]
+                    heads[i] = next(iterator, None)
+                with profile_serialization(self.request):
+                    item[name] = serializer(rows, many=True).data
+            yield item
@@ -39,6 +39,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'finance.base.profiling.QueryProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -105,6 +106,18 @@ STATICFILES_FINDERS = (
 )
 
 
+# Cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'finance',
+    }
+}
+
+INTERNAL_IPS = ('127.0.0.1',)
+
+
 # Session
 
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 7 * 4
@@ -121,6 +134,53 @@ INSTALLED_APPS += (
 )
 
 
+# Parser
+
+NASDAQ_URL = 'http://www.nasdaq.com'
+
+PARSER_TIMEOUT = 30
+
+PARSER_RETRIES = 3
+
+PARSER_BACKOFF = 0.5
+
+PARSER_BACKOFF_MAX = 30
+
+PARSER_POOL_SIZE = 10
+
+PARSER_CACHE_DIR = os.path.join(PROJECT_DIR, 'cache', 'http')
+
+PARSER_CACHE_TTL = 60 * 60
+
+PARSER_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+
+# API
+
+# CACHES alias for API responses, None disables the cache
+API_CACHE = 'default'
+
+API_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Memoized StockPrice.objects.deltas results per process
+DELTA_CACHE_SIZE = 1000
+
+# In-process numpy price series for analytics and delta, 0 disables the store
+PRICE_STORE_MAX_SIZE = 64 * 1024 * 1024
+
+
+# Profiling
+
+# Fraction of requests profiled by QueryProfileMiddleware, 0 disables it.
+# Profiled requests keep their SQL, so only a small sample in production.
+QUERY_PROFILE_SAMPLE_RATE = 0.01
+
+# Profiled requests slower than this, seconds, are kept with their queries
+QUERY_PROFILE_SLOW_REQUEST = 0.5
+
+QUERY_PROFILE_SLOW_SAMPLES = 50
+
+
 # ==============================================================================
 # Logging
 # ==============================================================================
@@ -15,6 +15,8 @@ COMPRESS_ENABLED = not DEBUG
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+QUERY_PROFILE_SAMPLE_RATE = 1.0
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',